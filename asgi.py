@@ -0,0 +1,277 @@
+"""
+ASGIエントリーポイント
+
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT
+    (または gunicorn asgi:app -k uvicorn.workers.UvicornWorker)
+
+/api/analyze・/api/analyze/stream・/api/google/tasks は async_engine の非同期パイプラインで処理し、
+それ以外のルートは既存の Flask アプリ (server.app) にそのまま渡す。
+Flask のセッションCookieを共有するので、ログイン状態や履歴のユーザーIDはどちらでも同じ。
+"""
+
+import json
+import asyncio
+import traceback
+
+from asgiref.wsgi import WsgiToAsgi
+
+import server
+from async_engine import AsyncEngine
+
+flask_app = WsgiToAsgi(server.app)
+engine = AsyncEngine()
+
+
+# --- Flask セッションCookieの読み書き ---
+
+def _session_serializer():
+    return server.app.session_interface.get_signing_serializer(server.app)
+
+def load_session(headers):
+    """リクエストヘッダーの Flask セッションCookieを dict として読み込む"""
+    from http.cookies import SimpleCookie
+
+    cookie_name = server.app.config.get('SESSION_COOKIE_NAME', 'session')
+    cookie = SimpleCookie()
+    cookie.load(headers.get('cookie', ''))
+    if cookie_name not in cookie:
+        return {}
+    try:
+        max_age = int(server.app.permanent_session_lifetime.total_seconds())
+        return dict(_session_serializer().loads(cookie[cookie_name].value, max_age=max_age))
+    except Exception:
+        return {}
+
+def session_cookie_header(session_data):
+    cookie_name = server.app.config.get('SESSION_COOKIE_NAME', 'session')
+    value = _session_serializer().dumps(session_data)
+    return (b'set-cookie', f"{cookie_name}={value}; HttpOnly; Path=/; SameSite=Lax".encode('latin-1'))
+
+def ensure_user_id(session_data):
+    """server.get_session_user_id と同じく、匿名ユーザーIDを発行する。新規発行ならTrue"""
+    if 'user_id' in session_data:
+        return False
+    import uuid
+    session_data['user_id'] = uuid.uuid4().hex
+    return True
+
+
+# --- ASGI ヘルパー ---
+
+async def read_json_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    if not body:
+        return {}
+    return json.loads(body)
+
+async def wait_for_disconnect(receive):
+    """本文を読み終えた後、クライアントが切断するまで待つ"""
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+async def send_json(send, payload, status=200, extra_headers=()):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    headers = [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+    headers.extend(extra_headers)
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+# --- 非同期ルート ---
+
+async def prepare_analyze_request(receive, send, headers):
+    """
+    解析リクエストを検証して (items, options, session_data, cookie_headers) を返す
+    エラー時はレスポンスを送って None を返す
+    """
+    if not server.GEMINI_API_KEY:
+        return await send_json(send, {"error": "Gemini APIキーが設定されていません。"}, 500)
+
+    try:
+        deadline = server.get_request_deadline({server.DEADLINE_HEADER: headers.get(server.DEADLINE_HEADER.lower())})
+    except ValueError as e:
+        return await send_json(send, {"error": f"{server.DEADLINE_HEADER} が不正です: {e}"}, 400)
+
+    try:
+        data = await read_json_body(receive)
+    except ValueError:
+        return await send_json(send, {"error": "JSONが不正です"}, 400)
+    if data is None:
+        return None
+
+    try:
+        # 再生リストの展開は yt-dlp (ブロッキング) なのでスレッドで行う
+        items, options = await asyncio.to_thread(server.parse_analyze_request, data)
+        options['deadline'] = deadline
+    except ValueError as e:
+        return await send_json(send, {"error": f"パラメータが不正です: {e}"}, 400)
+    except Exception as e:
+        traceback.print_exc()
+        return await send_json(send, {"error": f"再生リスト・チャンネルの展開に失敗しました: {e}"}, 500)
+
+    if not items:
+        return await send_json(send, {"error": "URLまたはアイテムが必要です"}, 400)
+
+    session_data = load_session(headers)
+    cookie_headers = [session_cookie_header(session_data)] if ensure_user_id(session_data) else []
+    return items, options, session_data, cookie_headers
+
+async def run_until_disconnect(coro, receive):
+    """
+    coro を実行し、先にクライアントが切断したら取り消す
+    戻り値: 完了したら True、切断で取り消したら False
+    """
+    work = asyncio.create_task(coro)
+    disconnect = asyncio.create_task(wait_for_disconnect(receive))
+    await asyncio.wait({work, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+
+    if not work.done():
+        # 誰も結果を受け取らないので、実行中の解析を全て取り消す
+        print("Client disconnected. Cancelling analysis...")
+        work.cancel()
+        await asyncio.gather(work, return_exceptions=True)
+        return False
+    disconnect.cancel()
+    work.result()  # 例外があればここで送出する
+    return True
+
+async def analyze_videos(scope, receive, send, headers):
+    """POST /api/analyze の非同期版 (リクエスト・レスポンスの形式は Flask 版と同じ)"""
+    prepared = await prepare_analyze_request(receive, send, headers)
+    if not prepared:
+        return
+    items, options, session_data, cookie_headers = prepared
+
+    print(f"Start analyzing {len(items)} videos (async)...")
+    response = {}
+
+    async def analyze():
+        response['result'] = await engine.analyze(
+            items, session_data['user_id'], force=options['force'], deadline=options['deadline'], priority=options['priority']
+        )
+
+    if await run_until_disconnect(analyze(), receive):
+        payload, status = response['result']
+        await send_json(send, payload, status, cookie_headers)
+
+async def analyze_videos_stream(scope, receive, send, headers):
+    """
+    POST /api/analyze/stream の非同期版。Flask 版と同じく進捗をNDJSONで送る
+    イベント: expanded → progress (動画ごと、完了順) → done
+    """
+    prepared = await prepare_analyze_request(receive, send, headers)
+    if not prepared:
+        return
+    items, options, session_data, cookie_headers = prepared
+    user_id = session_data['user_id']
+
+    async def send_event(data):
+        body = (json.dumps(data, ensure_ascii=False) + "\n").encode('utf-8')
+        await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+
+    async def stream():
+        response_headers = [(b'content-type', b'application/x-ndjson')]
+        response_headers.extend(cookie_headers)
+        await send({'type': 'http.response.start', 'status': 200, 'headers': response_headers})
+        await send_event({
+            "event": "expanded",
+            "total": len(items),
+            "items": [{"url": item['url'], "title": item.get('title')} for item in items]
+        })
+
+        results = [None] * len(items)
+        completed = 0
+        analysis = engine.iter_analyze(
+            items, user_id, force=options['force'], deadline=options['deadline'], priority=options['priority']
+        )
+        try:
+            async for index, res in analysis:
+                results[index] = res
+                completed += 1
+                await send_event({"event": "progress", "index": index, "completed": completed, "total": len(items), "result": res})
+        finally:
+            await analysis.aclose()
+
+        payload, status = await engine.consolidate(results, user_id, options['deadline'], options['priority'])
+        await send_event({"event": "done", "status": status, "result": payload})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    print(f"Start analyzing {len(items)} videos (async stream)...")
+    await run_until_disconnect(stream(), receive)
+
+async def add_tasks(scope, receive, send, headers):
+    """POST /api/google/tasks の非同期版"""
+    session_data = load_session(headers)
+    if 'credentials' not in session_data:
+        return await send_json(send, {"error": "Not authenticated"}, 401)
+
+    try:
+        creds = await asyncio.to_thread(server.load_google_credentials, session_data)
+    except Exception as e:
+        return await send_json(send, {"error": str(e)}, 500)
+    if not creds:
+        return await send_json(send, {"error": "Not authenticated"}, 401)
+
+    try:
+        data = await read_json_body(receive)
+    except ValueError:
+        return await send_json(send, {"error": "JSONが不正です"}, 400)
+    if data is None:
+        return
+
+    tasklist_id = data.get('tasklist_id')
+    tasks = data.get('tasks', [])
+    on_duplicate = data.get('on_duplicate', 'update')
+    if not tasklist_id or not tasks:
+        return await send_json(send, {"error": "Missing tasklist_id or tasks"}, 400)
+    if on_duplicate not in ('update', 'skip'):
+        return await send_json(send, {"error": "on_duplicate must be 'update' or 'skip'"}, 400)
+
+    try:
+        results = await engine.insert_tasks(creds.token, tasklist_id, tasks, on_duplicate=on_duplicate)
+    except Exception as e:
+        print(f"Error fetching existing tasks: {e}")
+        return await send_json(send, {"error": f"既存タスクの取得に失敗しました: {e}"}, 500)
+    # リフレッシュされた認証情報をセッションに書き戻す
+    await send_json(send, results, 200, [session_cookie_header(session_data)])
+
+ASYNC_ROUTES = {
+    ('POST', '/api/analyze'): analyze_videos,
+    ('POST', '/api/analyze/stream'): analyze_videos_stream,
+    ('POST', '/api/google/tasks'): add_tasks,
+}
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await engine.start()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await engine.aclose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    if scope['type'] == 'http':
+        handler = ASYNC_ROUTES.get((scope['method'], scope['path']))
+        if handler:
+            # lifespan非対応のサーバーでも動くように、必要なら初回にクライアントを作る
+            await engine.start()
+            headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope['headers']}
+            return await handler(scope, receive, send, headers)
+
+    await flask_app(scope, receive, send)
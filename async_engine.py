@@ -0,0 +1,405 @@
+"""
+解析パイプラインの asyncio 版 (asgi.py から利用する)
+
+server.py の同期版と同じ処理を行うが、HTTP呼び出しは共有の非同期クライアントで行い、
+上流 (YouTube / Invidious / Gemini / Google Tasks) ごとにセマフォで同時実行数を制限する。
+1プロセスで数百件の解析を同時に抱えても、スレッド数とメモリが増えない。
+
+youtube-transcript-api / yt-dlp はブロッキングなライブラリなので、
+YouTube用セマフォの範囲内でスレッドに逃がして実行する。
+"""
+
+import os
+import random
+import asyncio
+import traceback
+
+import server
+
+# 上流ごとの同時実行数 (プロセス全体で共有)
+ASYNC_YOUTUBE_CONCURRENCY = int(os.environ.get('ASYNC_YOUTUBE_CONCURRENCY', 4))
+ASYNC_INVIDIOUS_CONCURRENCY = int(os.environ.get('ASYNC_INVIDIOUS_CONCURRENCY', 16))
+ASYNC_GEMINI_CONCURRENCY = int(os.environ.get('ASYNC_GEMINI_CONCURRENCY', 8))
+ASYNC_GOOGLE_TASKS_CONCURRENCY = int(os.environ.get('ASYNC_GOOGLE_TASKS_CONCURRENCY', 4))
+
+# Invidious は1件の字幕取得につき何インスタンスまで同時に試すか
+INVIDIOUS_PROBE_PARALLELISM = int(os.environ.get('INVIDIOUS_PROBE_PARALLELISM', 3))
+
+GOOGLE_TASKS_API_URL = "https://tasks.googleapis.com/tasks/v1"
+
+
+class AsyncEngine:
+    """
+    非同期の解析エンジン。start() で HTTPクライアントを作り、aclose() で閉じる
+    """
+
+    def __init__(self, api_key=None):
+        self.api_key = api_key or server.GEMINI_API_KEY
+        self._client = None
+        self.youtube_semaphore = asyncio.Semaphore(ASYNC_YOUTUBE_CONCURRENCY)
+        self.invidious_semaphore = asyncio.Semaphore(ASYNC_INVIDIOUS_CONCURRENCY)
+        self.gemini_semaphore = asyncio.Semaphore(ASYNC_GEMINI_CONCURRENCY)
+        self.google_tasks_semaphore = asyncio.Semaphore(ASYNC_GOOGLE_TASKS_CONCURRENCY)
+        self._tasks_index_locks = {}
+
+    async def start(self):
+        import httpx
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(60.0, connect=10.0),
+                limits=httpx.Limits(max_connections=200, max_keepalive_connections=50)
+            )
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            raise RuntimeError("AsyncEngine.start() has not been called")
+        return self._client
+
+    # --- 字幕取得 ---
+
+    async def fetch_transcript(self, url, video_id, deadline):
+        """YouTube (スレッド実行) → Invidious (非同期) の順に字幕を探す"""
+        async with self.youtube_semaphore:
+            deadline.check()
+            # スレッドは取り消せないので、deadline を渡して段階の間で打ち切らせる
+            transcript_text = await asyncio.to_thread(server.fetch_transcript_from_youtube, url, video_id, deadline)
+        if transcript_text:
+            return transcript_text
+
+        deadline.check()
+        print("yt-dlp failed. Trying Invidious API fallback...")
+        return await self.fetch_transcript_from_invidious(video_id, deadline)
+
+    async def _probe_invidious(self, instance, video_id, deadline):
+        """1インスタンスから字幕を取得する。失敗したら空文字"""
+        try:
+            async with self.invidious_semaphore:
+                meta_res = await self.client.get(f"{instance}/api/v1/videos/{video_id}", timeout=deadline.timeout(15))
+                if meta_res.status_code != 200:
+                    print(f"  -> Meta fetch failed ({instance}): {meta_res.status_code}")
+                    return ""
+
+                target_caption = server.pick_invidious_caption(meta_res.json().get('captions', []))
+                if not target_caption:
+                    print(f"  -> No Japanese/English caption found in {instance}")
+                    return ""
+
+                cap_res = await self.client.get(server.invidious_caption_url(instance, target_caption), timeout=deadline.timeout(15))
+                if cap_res.status_code != 200:
+                    print(f"  -> Caption fetch failed ({instance}): {cap_res.status_code}")
+                    return ""
+                return server.vtt_to_text(cap_res.text.splitlines())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Invidious instance {instance} error: {e}")
+            return ""
+
+    async def fetch_transcript_from_invidious(self, video_id, deadline):
+        """
+        Invidiousインスタンスを数件ずつ同時に試し、最初に取れた字幕を返す (残りは取り消す)
+        """
+        instances = list(server.INVIDIOUS_INSTANCES)
+        random.shuffle(instances)
+
+        for start in range(0, len(instances), INVIDIOUS_PROBE_PARALLELISM):
+            deadline.check()
+            wave = instances[start:start + INVIDIOUS_PROBE_PARALLELISM]
+            tasks = {asyncio.create_task(self._probe_invidious(instance, video_id, deadline)): instance for instance in wave}
+            try:
+                for finished in asyncio.as_completed(tasks):
+                    transcript_text = await finished
+                    if transcript_text:
+                        print("Successfully fetched from Invidious!")
+                        return transcript_text
+            finally:
+                for task in tasks:
+                    task.cancel()
+        return ""
+
+    # --- Gemini ---
+
+    async def call_gemini(self, prompt_text, deadline=None):
+        """server.call_gemini_api の非同期版"""
+        print("Calling Gemini API (async)...")
+        deadline = deadline or server.Deadline()
+        # モデル一覧はディスクキャッシュ済みならすぐ返る
+        models = await asyncio.to_thread(server.get_gemini_models_to_try, self.api_key)
+
+        last_error = None
+        for model in models:
+            deadline.check()
+            try:
+                api_url, payload = server.build_gemini_request(prompt_text, model, self.api_key)
+                async with self.gemini_semaphore:
+                    response = await self.client.post(api_url, json=payload, timeout=deadline.timeout(60.0))
+
+                if response.status_code == 200:
+                    return server.parse_gemini_response(response.json())
+                elif response.status_code == 429:
+                    print(f"Model {model} quota exceeded. Trying next...")
+                    last_error = f"Quota exceeded for {model}"
+                else:
+                    print(f"Model {model} failed: {response.status_code}")
+                    last_error = f"{model} error: {response.text}"
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error model {model}: {e}")
+                last_error = f"{e} (Traceback: {traceback.format_exc()})"
+
+        deadline.check()
+        raise Exception(f"All models failed. Last error: {last_error}")
+
+    # --- 解析パイプライン ---
+
+    async def process_single_video(self, url, provided_transcript=None, deadline=None):
+        """server.process_single_video の非同期版"""
+        try:
+            return await self._process_single_video(url, provided_transcript, deadline or server.Deadline())
+        except server.DeadlineExceeded:
+            print(f"Deadline exceeded for {url}")
+            return server.timeout_result(url)
+
+    async def _process_single_video(self, url, provided_transcript, deadline):
+        print(f"Processing URL (async): {url}")
+        video_id = server.extract_video_id(url)
+        if not video_id:
+            return {"error": "Invalid URL", "url": url}
+
+        transcript_text = provided_transcript or ""
+        if not transcript_text:
+            transcript_text = await self.fetch_transcript(url, video_id, deadline)
+
+        if not transcript_text:
+            print(f"All methods failed for {url}")
+            return {"error": server.SUBTITLE_NOT_FOUND_ERROR, "url": url}
+
+        try:
+            result = await self.call_gemini(server.build_video_prompt(transcript_text), deadline)
+            return await asyncio.to_thread(server.build_video_result, result, url, transcript_text)
+        except (asyncio.CancelledError, server.DeadlineExceeded):
+            raise
+        except Exception as e:
+            return server.build_video_error(e, url, transcript_text)
+
+    async def analyze_video_with_store(self, url, user_id, provided_transcript=None, force=False, deadline=None, priority='interactive'):
+        """
+        保存済みの新しい結果があれば再利用し、なければ解析して保存する
+        解析は Flask 側と共有の公平スケジューラーの実行枠を得てから行う
+        """
+        from scheduler import SchedulerTimeout
+
+        video_id = server.extract_video_id(url)
+        deadline = deadline or server.Deadline()
+        try:
+            if not force:
+                stored = await asyncio.to_thread(server.lookup_stored_analysis, url, video_id, user_id)
+                if stored:
+                    return stored
+
+            try:
+                async with server.get_analysis_scheduler().async_slot(user_id, priority, timeout=deadline.remaining()):
+                    res = await self.process_single_video(url, provided_transcript=provided_transcript, deadline=deadline)
+            except SchedulerTimeout:
+                print(f"Deadline exceeded while waiting in queue: {url}")
+                return server.timeout_result(url)
+            return await asyncio.to_thread(server.record_analysis, res, user_id, video_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            traceback.print_exc()
+            return {"error": f"Analysis error: {e}", "url": url}
+
+    async def iter_analyze(self, items, user_id, force=False, deadline=None, priority='interactive'):
+        """
+        複数動画を同時に解析し、完了した順に (index, 結果) を返す非同期ジェネレーター
+        同時実行数は上流ごとのセマフォで制限される。
+        期限を過ぎたら未完了の動画を取り消し、それらはタイムアウト結果として返す。
+        取り消された場合・途中で閉じられた場合 (クライアント切断) は全ての解析を取り消す
+        """
+        deadline = deadline or server.Deadline()
+        tasks = {
+            asyncio.create_task(self.analyze_video_with_store(
+                item['url'], user_id, provided_transcript=item.get('transcript'), force=force, deadline=deadline, priority=priority
+            )): index
+            for index, item in enumerate(items)
+        }
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=deadline.remaining(), return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break
+                for task in done:
+                    yield tasks[task], task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                # スレッドで実行中の字幕取得にも打ち切りを知らせる
+                deadline.cancel()
+
+        if pending:
+            print(f"Deadline exceeded. {len(pending)} videos did not finish.")
+        for task in pending:
+            index = tasks[task]
+            yield index, server.timeout_result(items[index]['url'])
+
+    async def analyze(self, items, user_id, force=False, deadline=None, priority='interactive'):
+        """
+        複数動画を同時に解析して統合する。戻り値: (レスポンス本体, ステータスコード)
+        期限を過ぎた場合は部分結果 (status=timeout) を返す
+        """
+        deadline = deadline or server.Deadline()
+        results = [None] * len(items)
+        async for index, res in self.iter_analyze(items, user_id, force=force, deadline=deadline, priority=priority):
+            results[index] = res
+        return await self.consolidate(results, user_id, deadline, priority)
+
+    async def consolidate(self, results, user_id, deadline=None, priority='interactive'):
+        """個別結果を統合する (server.consolidate_results の非同期版)"""
+        deadline = deadline or server.Deadline()
+        early_response, context = await asyncio.to_thread(server.prepare_consolidation, results)
+        if early_response:
+            return early_response
+        if deadline.expired():
+            return server.partial_results_response(results, context)
+
+        from scheduler import SchedulerTimeout
+        try:
+            async with server.get_analysis_scheduler().async_slot(user_id, priority, timeout=deadline.remaining()):
+                final_result = await self.call_gemini(context['prompt'], deadline)
+            return await asyncio.to_thread(server.finish_consolidation, final_result, results, context, user_id)
+        except asyncio.CancelledError:
+            raise
+        except (server.DeadlineExceeded, SchedulerTimeout):
+            return server.partial_results_response(results, context)
+        except Exception as e:
+            return server.consolidation_failed(e, results, context)
+
+    # --- Google Tasks ---
+
+    async def _google_tasks_request(self, method, url, access_token, **kwargs):
+        headers = {"Authorization": f"Bearer {access_token}", **kwargs.pop('headers', {})}
+        async with self.google_tasks_semaphore:
+            response = await self.client.request(method, url, headers=headers, **kwargs)
+        if response.status_code not in (200, 304):
+            raise Exception(f"{response.status_code} {response.text}")
+        return response
+
+    async def resolve_tasklist_id(self, access_token, tasklist_id):
+        """server.resolve_tasklist_id の非同期版 (@default などの別名を実際のIDに解決する)"""
+        from urllib.parse import quote
+
+        if not server.is_tasklist_alias(tasklist_id):
+            return tasklist_id
+        response = await self._google_tasks_request(
+            'GET', f"{GOOGLE_TASKS_API_URL}/users/@me/lists/{quote(tasklist_id, safe='')}", access_token
+        )
+        return response.json()['id']
+
+    async def sync_tasks_index(self, access_token, tasklist_id):
+        """
+        server.sync_tasks_index の非同期版。tasklist_id は解決済みのIDを渡す。
+        タスクリストを If-None-Match (ETag) で取得し、304なら索引をそのまま使う。
+        変わっていれば前回同期以降の変更だけ (updatedMin) をページングして取得する
+        """
+        from urllib.parse import quote
+
+        if server.is_tasklist_alias(tasklist_id):
+            raise ValueError(f"Resolve the tasklist alias first: {tasklist_id}")
+        index = await asyncio.to_thread(server.load_tasks_index, tasklist_id)
+        list_id = quote(tasklist_id, safe='')
+
+        headers = {}
+        if index and index.get('tasklist_etag'):
+            headers['If-None-Match'] = index['tasklist_etag']
+        response = await self._google_tasks_request(
+            'GET', f"{GOOGLE_TASKS_API_URL}/users/@me/lists/{list_id}", access_token, headers=headers
+        )
+        if response.status_code == 304:
+            return index
+        tasklist = response.json()
+        if index and index.get('tasklist_updated') == tasklist.get('updated'):
+            return index
+
+        synced_at = server.tasks_sync_timestamp()
+        params = {'maxResults': 100, 'showCompleted': 'true', 'showHidden': 'true'}
+        if index and index.get('synced_at'):
+            params.update(updatedMin=index['synced_at'], showDeleted='true')
+        else:
+            index = server.new_tasks_index(tasklist_id)
+
+        while True:
+            page = (await self._google_tasks_request(
+                'GET', f"{GOOGLE_TASKS_API_URL}/lists/{list_id}/tasks", access_token, params=params
+            )).json()
+            server.merge_task_changes(index, page.get('items', []))
+            if not page.get('nextPageToken'):
+                break
+            params['pageToken'] = page['nextPageToken']
+
+        index['tasklist_etag'] = tasklist.get('etag')
+        index['tasklist_updated'] = tasklist.get('updated')
+        index['synced_at'] = synced_at
+        return index
+
+    def _tasks_index_lock(self, tasklist_id):
+        """同じタスクリストへの同時エクスポートを直列化する"""
+        return self._tasks_index_locks.setdefault(tasklist_id, asyncio.Lock())
+
+    async def insert_tasks(self, access_token, tasklist_id, tasks, on_duplicate='update'):
+        """
+        server.add_tasks の非同期版。既存タスクと同じタイトルのものは追加しない
+        (並び順を保つため1リクエスト内では逐次、リクエスト間はセマフォで制限)
+        """
+        from urllib.parse import quote
+
+        # 索引とロックはアカウント固有のIDで管理する (@default のままだと別アカウントと共有される)
+        tasklist_id = await self.resolve_tasklist_id(access_token, tasklist_id)
+        url = f"{GOOGLE_TASKS_API_URL}/lists/{quote(tasklist_id, safe='')}/tasks"
+        async with self._tasks_index_lock(tasklist_id):
+            index = await self.sync_tasks_index(access_token, tasklist_id)
+            title_index = server.build_title_index(index)
+            results = []
+            print(f"Adding {len(tasks)} tasks to list {tasklist_id} (async)...")
+
+            for task in tasks:
+                body = {'title': task.get('title'), 'notes': task.get('notes', '')}
+                try:
+                    action, existing_id = server.plan_task_export(index, title_index, task, on_duplicate)
+                    if action == 'skip':
+                        results.append({"status": "success", "action": "skipped", "id": existing_id, "title": task.get('title')})
+                        continue
+                    if action == 'update':
+                        response = await self._google_tasks_request(
+                            'PATCH', f"{url}/{quote(existing_id, safe='')}", access_token, json={'notes': body['notes']}
+                        )
+                    else:
+                        response = await self._google_tasks_request('POST', url, access_token, json=body)
+                    result = response.json()
+                    results.append({
+                        "status": "success",
+                        "action": "updated" if action == 'update' else "inserted",
+                        "id": result.get('id'),
+                        "title": result.get('title')
+                    })
+                    # 同じリクエスト内の重複も防ぐため、すぐ索引に反映する
+                    server.record_task_in_index(index, result, title_index)
+                    # レート制限回避のため少しウェイト
+                    await asyncio.sleep(0.5)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print(f"Error adding task: {e}")
+                    results.append({"status": "error", "error": str(e), "title": task.get('title')})
+
+            await asyncio.to_thread(server.save_tasks_index, tasklist_id, index)
+        return results
@@ -0,0 +1,192 @@
+"""
+大量の動画URLをWebサーバーを通さずに解析するバッチCLI
+
+入力 (JSONL, 1行1件):
+    {"url": "https://www.youtube.com/watch?v=...", "transcript": "(任意)"}
+    "https://youtu.be/..."            (URL文字列だけでも可)
+    再生リスト・チャンネルURLは動画URLに展開される
+
+使い方:
+    python batch.py urls.jsonl -o results.jsonl
+    cat urls.jsonl | python batch.py - -o results.jsonl --workers 8 --mode process
+    python batch.py channels.jsonl -o results.jsonl --max-videos 1000 --published-after 2024-01-01
+
+結果は完了した順に出力JSONLへ追記する。完了した動画はチェックポイントファイル
+(デフォルト: <出力>.checkpoint) に記録され、再実行時はスキップされる。
+エラーになった動画は記録しないので、再実行すると再試行される。
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import traceback
+
+# バッチ処理ではレイテンシより総スループットが重要なので、事前読み込みスレッドは使わない
+os.environ.setdefault('WARMUP_IMPORTS', '0')
+
+import server
+
+def iter_input_items(stream, max_videos=None, published_after=None, published_before=None):
+    """
+    JSONLから {"url", "transcript"} を1件ずつ返す (再生リスト等は展開する)
+    max_videos: 再生リスト・チャンネル1件あたりの展開上限 (Noneならサーバーと同じ PLAYLIST_MAX_ITEMS)
+    published_after / published_before: 展開時の投稿日の絞り込み ('YYYYMMDD' / 'YYYY-MM-DD')
+    """
+    max_videos = max_videos or server.PLAYLIST_MAX_ITEMS
+    published_after = server._normalize_date(published_after)
+    published_before = server._normalize_date(published_before)
+    for line_no, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except json.JSONDecodeError as e:
+            print(f"Skipping line {line_no}: invalid JSON ({e})", file=sys.stderr)
+            continue
+        if isinstance(item, str):
+            item = {"url": item}
+        if not isinstance(item, dict) or not item.get('url'):
+            print(f"Skipping line {line_no}: 'url' is missing", file=sys.stderr)
+            continue
+
+        url = item['url'].strip()
+        if server.is_collection_url(url):
+            try:
+                for child in server.expand_collection_url(
+                    url, max_items=max_videos, published_after=published_after, published_before=published_before
+                ):
+                    yield child
+            except Exception as e:
+                print(f"Skipping line {line_no}: failed to expand {url} ({e})", file=sys.stderr)
+            continue
+        yield {"url": url, "transcript": item.get('transcript')}
+
+def item_key(item):
+    """チェックポイント用のキー (動画IDがなければURL)"""
+    return server.extract_video_id(item['url']) or item['url']
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'r', encoding='utf-8') as f:
+        return {line.strip() for line in f if line.strip()}
+
+def run_item(item):
+    """ワーカーで1件解析する (プロセスプールから呼ばれるためモジュールレベルに置く)"""
+    try:
+        return server.process_single_video(item['url'], server.GEMINI_API_KEY, provided_transcript=item.get('transcript'))
+    except Exception as e:
+        return {"error": f"Unexpected error: {e}", "error_detail": traceback.format_exc(), "url": item['url']}
+
+def run_batch(items, output_path, checkpoint_path, workers=4, mode='thread', progress_interval=10):
+    """
+    itemsを並列に解析し、完了した順に出力・チェックポイントへ書き込む
+    戻り値: 集計 dict
+    """
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+    done_keys = load_checkpoint(checkpoint_path)
+    if done_keys:
+        print(f"Resuming: {len(done_keys)} videos already completed", file=sys.stderr)
+
+    executor_class = ProcessPoolExecutor if mode == 'process' else ThreadPoolExecutor
+    stats = {"succeeded": 0, "failed": 0, "skipped": 0}
+    started = time.time()
+    last_report = started
+
+    with open(output_path, 'a', encoding='utf-8') as out, \
+         open(checkpoint_path, 'a', encoding='utf-8') as checkpoint, \
+         executor_class(max_workers=workers) as executor:
+
+        in_flight = {}
+
+        def drain(return_when):
+            nonlocal last_report
+            done, _ = wait(in_flight, return_when=return_when)
+            for future in done:
+                key, item = in_flight.pop(future)
+                res = future.result()
+                out.write(json.dumps({"key": key, "url": item['url'], "result": res}, ensure_ascii=False) + "\n")
+                out.flush()
+                if "error" in res:
+                    stats["failed"] += 1
+                    print(f"[failed] {item['url']}: {res['error']}", file=sys.stderr)
+                else:
+                    stats["succeeded"] += 1
+                    # 出力を書き終えてから完了を記録する (途中で落ちても結果は失われない)
+                    checkpoint.write(key + "\n")
+                    checkpoint.flush()
+                    os.fsync(checkpoint.fileno())
+                    done_keys.add(key)
+
+            now = time.time()
+            if now - last_report >= progress_interval:
+                last_report = now
+                report_throughput(stats, now - started)
+
+        # 入力を全部メモリに載せないよう、実行中の件数を制限しながら投入する
+        for item in items:
+            key = item_key(item)
+            if key in done_keys:
+                stats["skipped"] += 1
+                continue
+            done_keys.add(key)  # 入力内の重複も1回だけ処理する
+            in_flight[executor.submit(run_item, item)] = (key, item)
+            if len(in_flight) >= workers * 2:
+                drain(FIRST_COMPLETED)
+
+        while in_flight:
+            drain(FIRST_COMPLETED)
+
+    stats["elapsed"] = time.time() - started
+    report_throughput(stats, stats["elapsed"])
+    return stats
+
+def report_throughput(stats, elapsed):
+    processed = stats["succeeded"] + stats["failed"]
+    rate = processed / elapsed * 60 if elapsed > 0 else 0.0
+    print(
+        f"[progress] succeeded={stats['succeeded']} failed={stats['failed']} "
+        f"skipped={stats['skipped']} elapsed={elapsed:.1f}s throughput={rate:.1f} videos/min",
+        file=sys.stderr
+    )
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="YouTube動画をJSONLから一括解析する")
+    parser.add_argument('input', help="入力JSONLファイル ('-' で標準入力)")
+    parser.add_argument('-o', '--output', required=True, help="結果を追記する出力JSONLファイル")
+    parser.add_argument('--checkpoint', help="チェックポイントファイル (デフォルト: <出力>.checkpoint)")
+    parser.add_argument('--workers', type=int, default=server.INGEST_CONCURRENCY, help="並列数")
+    parser.add_argument('--mode', choices=['thread', 'process'], default='thread', help="ワーカーの種類")
+    parser.add_argument('--max-videos', type=int, default=server.PLAYLIST_MAX_ITEMS,
+                        help="再生リスト・チャンネル1件あたりの最大動画数 (Webの上限とは独立)")
+    parser.add_argument('--published-after', help="再生リスト・チャンネルの動画をこの日付以降に絞る (YYYY-MM-DD)")
+    parser.add_argument('--published-before', help="再生リスト・チャンネルの動画をこの日付以前に絞る (YYYY-MM-DD)")
+    args = parser.parse_args(argv)
+
+    try:
+        filters = {
+            "max_videos": args.max_videos,
+            "published_after": server._normalize_date(args.published_after),
+            "published_before": server._normalize_date(args.published_before),
+        }
+    except ValueError as e:
+        parser.error(str(e))
+
+    if not server.GEMINI_API_KEY:
+        print("GEMINI_API_KEY is not set", file=sys.stderr)
+        return 1
+
+    checkpoint_path = args.checkpoint or f"{args.output}.checkpoint"
+    if args.input == '-':
+        stats = run_batch(iter_input_items(sys.stdin, **filters), args.output, checkpoint_path, workers=args.workers, mode=args.mode)
+    else:
+        with open(args.input, 'r', encoding='utf-8') as f:
+            stats = run_batch(iter_input_items(f, **filters), args.output, checkpoint_path, workers=args.workers, mode=args.mode)
+    return 0 if stats["failed"] == 0 else 2
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,299 @@
+"""
+YouTube用Cookieの管理
+
+起動時に cookies.txt (なければ環境変数 YOUTUBE_COOKIES) を一度だけ読み込み、
+Netscape形式として検証したうえで以下の形で共有する:
+
+- path(): 正規化した Cookie ファイル (youtube-transcript-api など、パスを受け取るライブラリ用)
+- cookiejar(): メモリ上の CookieJar (yt-dlp・requests 用。ファイルへの書き戻しは行わない)
+
+動画ごとに一時ファイルを作り直すことはしない。cookies.txt は更新日時を監視し、
+変わったら読み込み直す。取得の成否を記録し、失敗が続いたら期限切れの疑いとして知らせる。
+"""
+
+import os
+import time
+import threading
+
+NETSCAPE_HEADER = "# Netscape HTTP Cookie File"
+HTTPONLY_PREFIX = "#HttpOnly_"
+
+# ログイン状態を表すCookie (これらの有効期限をCookie全体の期限とみなす)
+AUTH_COOKIE_NAMES = ('SID', 'HSID', 'SSID', 'APISID', 'SAPISID', '__Secure-1PSID', '__Secure-3PSID', 'LOGIN_INFO')
+
+
+def parse_netscape_cookies(text):
+    """
+    Netscape形式のCookieを解析する
+    戻り値: (cookies, invalid_lines)  cookies は dict のリスト、invalid_lines は不正な行番号のリスト
+    """
+    cookies = []
+    invalid_lines = []
+    for line_no, line in enumerate(text.splitlines(), 1):
+        line = line.strip('\r\n')
+        http_only = line.startswith(HTTPONLY_PREFIX)
+        if http_only:
+            line = line[len(HTTPONLY_PREFIX):]
+        elif not line.strip() or line.lstrip().startswith('#'):
+            continue
+
+        fields = line.split('\t')
+        if len(fields) == 6:
+            fields.append('')  # 値が空のCookie
+        if len(fields) != 7:
+            invalid_lines.append(line_no)
+            continue
+
+        domain, include_subdomains, path, secure, expires, name, value = fields
+        if not domain or not name or include_subdomains.upper() not in ('TRUE', 'FALSE') or secure.upper() not in ('TRUE', 'FALSE'):
+            invalid_lines.append(line_no)
+            continue
+        try:
+            expires = int(float(expires)) if expires else 0
+        except ValueError:
+            invalid_lines.append(line_no)
+            continue
+
+        # http.cookiejar は「先頭のドット」と「サブドメインを含む」フラグが一致しない行を拒否するので揃える
+        include_subdomains = include_subdomains.upper() == 'TRUE' or domain.startswith('.')
+        if include_subdomains and not domain.startswith('.'):
+            domain = '.' + domain
+
+        cookies.append({
+            "domain": domain,
+            "include_subdomains": include_subdomains,
+            "path": path or '/',
+            "secure": secure.upper() == 'TRUE',
+            "expires": expires,  # 0 はセッションCookie
+            "name": name,
+            "value": value,
+            "http_only": http_only,
+        })
+    return cookies, invalid_lines
+
+
+def format_netscape_cookies(cookies):
+    """解析済みのCookieをNetscape形式に書き戻す (ヘッダー付き。http.cookiejar でも読める)"""
+    lines = [NETSCAPE_HEADER, ""]
+    for c in cookies:
+        domain = f"{HTTPONLY_PREFIX}{c['domain']}" if c['http_only'] else c['domain']
+        lines.append("\t".join([
+            domain,
+            'TRUE' if c['include_subdomains'] else 'FALSE',
+            c['path'],
+            'TRUE' if c['secure'] else 'FALSE',
+            # セッションCookieは空欄にする ("0" だと http.cookiejar が期限切れとして扱い、送信されない)
+            str(c['expires']) if c['expires'] else '',
+            c['name'],
+            c['value'],
+        ]))
+    return "\n".join(lines) + "\n"
+
+
+class CookieProvider:
+    """
+    source_path: 監視する cookies.txt
+    env_var: cookies.txt がない場合に使う環境変数
+    materialized_path: 正規化したCookieファイルの書き出し先
+    check_interval: cookies.txt の更新確認の間隔 (秒)
+    failure_threshold: 連続で何回失敗したら期限切れを疑うか
+    """
+
+    def __init__(self, source_path='cookies.txt', env_var='YOUTUBE_COOKIES', materialized_path='.cache/youtube_cookies.txt',
+                 check_interval=5.0, failure_threshold=5):
+        self.source_path = source_path
+        self.env_var = env_var
+        self.materialized_path = materialized_path
+        self.check_interval = check_interval
+        self.failure_threshold = failure_threshold
+        self._lock = threading.Lock()
+        self._cookies = []
+        self._invalid_lines = []
+        self._source = None
+        self._source_stat = None
+        self._loaded_at = None
+        self._path = None
+        self._jar = None
+        self._last_check = 0.0
+        self._error = None
+        self._consecutive_failures = 0
+        self._failures_since_load = 0
+        self._successes_since_load = 0
+        self._last_success_at = None
+        self._last_failure_at = None
+        self._stale_warned = False
+
+    # --- 読み込み ---
+
+    def _stat_source(self):
+        try:
+            st = os.stat(self.source_path)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    def _read_source(self):
+        """(種類, テキスト, stat) を返す。Cookieが設定されていなければ (None, None, None)"""
+        source_stat = self._stat_source()
+        if source_stat:
+            with open(self.source_path, 'r', encoding='utf-8') as f:
+                return 'file', f.read(), source_stat
+        text = os.environ.get(self.env_var)
+        if text:
+            return 'env', text, None
+        return None, None, None
+
+    def _materialize(self, cookies):
+        """
+        正規化したCookieファイルを書き出し、同じ内容の CookieJar を返す
+        http.cookiejar で読めない場合は例外を出し、既存のファイルは置き換えない
+        """
+        from http.cookiejar import MozillaCookieJar
+
+        directory = os.path.dirname(self.materialized_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.materialized_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(format_netscape_cookies(cookies))
+            jar = MozillaCookieJar()
+            jar.load(tmp_path, ignore_discard=True, ignore_expires=True)
+            os.replace(tmp_path, self.materialized_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return jar
+
+    def load(self):
+        """Cookieを読み込み直す。失敗しても例外は出さず、status() の error に記録する"""
+        with self._lock:
+            self._last_check = time.monotonic()
+            try:
+                source, text, source_stat = self._read_source()
+                cookies, invalid_lines = parse_netscape_cookies(text) if text else ([], [])
+                if text and not cookies:
+                    raise ValueError(f"No valid cookies found in {source} (invalid lines: {invalid_lines[:10]})")
+                # 利用時ではなく読み込み時に CookieJar まで作り、不正なファイルはここで拒否する
+                jar = self._materialize(cookies) if cookies else None
+            except Exception as e:
+                # 読み込みに失敗したら、それまでのCookieを使い続ける
+                self._error = str(e)
+                self._source_stat = self._stat_source()
+                print(f"Failed to load YouTube cookies: {e}")
+                return False
+
+            self._cookies = cookies
+            self._invalid_lines = invalid_lines
+            self._source = source
+            self._source_stat = source_stat
+            self._loaded_at = time.time()
+            self._path = self.materialized_path if cookies else None
+            self._jar = jar
+            self._error = None
+            self._consecutive_failures = 0
+            self._failures_since_load = 0
+            self._successes_since_load = 0
+            self._stale_warned = False
+
+        if cookies:
+            print(f"Loaded {len(cookies)} YouTube cookies from {source}" + (f" ({len(invalid_lines)} invalid lines skipped)" if invalid_lines else ""))
+        return True
+
+    def refresh_if_changed(self):
+        """cookies.txt が更新・作成・削除されていたら読み込み直す (check_interval ごとに確認)"""
+        if time.monotonic() - self._last_check < self.check_interval:
+            return False
+        self._last_check = time.monotonic()
+        if self._stat_source() == self._source_stat:
+            return False
+        print("cookies.txt changed. Reloading YouTube cookies...")
+        return self.load()
+
+    # --- 利用側 ---
+
+    def path(self):
+        """正規化したCookieファイルのパス。Cookieが設定されていなければNone"""
+        self.refresh_if_changed()
+        return self._path
+
+    def cookiejar(self):
+        """
+        メモリ上の CookieJar (http.cookiejar.CookieJar) を返す。Cookieが設定されていなければNone
+        読み込みごとに1つだけ作り、全スレッドで共有する
+        """
+        self.refresh_if_changed()
+        return self._jar
+
+    def apply_to(self, target_jar):
+        """共有のCookieを別の CookieJar (yt-dlp の ydl.cookiejar など) に入れる"""
+        import copy
+        jar = self.cookiejar()
+        if jar is None:
+            return 0
+        count = 0
+        for cookie in jar:
+            target_jar.set_cookie(copy.copy(cookie))
+            count += 1
+        return count
+
+    # --- 成否の記録 ---
+
+    def record_result(self, success):
+        """字幕取得の成否を記録する。Cookie使用時に失敗が続いたら期限切れを疑って警告する"""
+        with self._lock:
+            if not self._cookies:
+                return
+            now = time.time()
+            if success:
+                self._consecutive_failures = 0
+                self._successes_since_load += 1
+                self._last_success_at = now
+                self._stale_warned = False
+                return
+            self._consecutive_failures += 1
+            self._failures_since_load += 1
+            self._last_failure_at = now
+            warn = self._consecutive_failures >= self.failure_threshold and not self._stale_warned
+            if warn:
+                self._stale_warned = True
+        if warn:
+            status = self.status()
+            print(
+                f"WARNING: {status['consecutive_failures']} consecutive transcript failures with cookies "
+                f"(age: {status['age_seconds']}s, auth cookies expire at: {status['auth_expires_at']}). "
+                "Cookies may be expired or invalidated. Please update cookies.txt / YOUTUBE_COOKIES."
+            )
+
+    def status(self):
+        """Cookieの状態 (デバッグ表示用。値そのものは含めない)"""
+        with self._lock:
+            now = time.time()
+            expiring = [c['expires'] for c in self._cookies if c['expires']]
+            auth_expiring = [c['expires'] for c in self._cookies if c['expires'] and c['name'] in AUTH_COOKIE_NAMES]
+            if self._source == 'file' and self._source_stat:
+                age = now - self._source_stat[0] / 1e9
+            elif self._loaded_at:
+                age = now - self._loaded_at
+            else:
+                age = None
+            return {
+                "source": self._source,
+                "path": self._path,
+                "cookie_count": len(self._cookies),
+                "invalid_lines": len(self._invalid_lines),
+                "expired_count": sum(1 for t in expiring if t <= now),
+                "has_auth_cookies": any(c['name'] in AUTH_COOKIE_NAMES for c in self._cookies),
+                "auth_expires_at": min(auth_expiring) if auth_expiring else None,
+                "earliest_expires_at": min(expiring) if expiring else None,
+                "loaded_at": self._loaded_at,
+                "age_seconds": int(age) if age is not None else None,
+                "error": self._error,
+                "successes_since_load": self._successes_since_load,
+                "failures_since_load": self._failures_since_load,
+                "consecutive_failures": self._consecutive_failures,
+                "suspected_stale": self._consecutive_failures >= self.failure_threshold,
+                "last_success_at": self._last_success_at,
+                "last_failure_at": self._last_failure_at,
+            }
@@ -0,0 +1,235 @@
+"""
+解析処理 (字幕取得・Gemini呼び出し) のための公平スケジューラー
+
+- (テナント, 優先度) ごとの重み付き公平キューイング (WFQ):
+  大量の動画を投入したユーザーがいても、他のユーザーの順番が後回しにならない
+- 優先度: interactive (少数の動画) は bulk (再生リスト等の大量投入) より重みが大きく、
+  多くの枠を得る。厳密な優先順位ではないので、interactive が続いても bulk は止まらない
+- テナントごとの同時実行数の上限
+- キュー待ち時間を優先度別に記録し、stats() で p50 / p95 を返す
+
+Flask (スレッド) からは slot()、ASGI (asyncio) からは async_slot() で使う。
+同じプロセス内では server.get_analysis_scheduler() の1つのインスタンスを共有するので、
+この2つの経路の間でも公平性が保たれる。
+バッチCLI (batch.py) はスケジューラーを通さずに解析するため、ここでの公平性の対象外。
+プロセスをまたいだ (gunicornの複数ワーカー間などの) 公平性も保証しない。
+"""
+
+import time
+import heapq
+import asyncio
+import threading
+import itertools
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+
+PRIORITY_INTERACTIVE = 'interactive'
+PRIORITY_BULK = 'bulk'
+
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_BULK)
+
+# 優先度ごとの重み (interactive は bulk の4倍の割合で枠を得る)
+DEFAULT_PRIORITY_WEIGHTS = {PRIORITY_INTERACTIVE: 4.0, PRIORITY_BULK: 1.0}
+
+
+class SchedulerTimeout(Exception):
+    """期限までに実行枠が得られなかった"""
+
+
+class _Ticket:
+    __slots__ = ('tenant', 'priority', 'start_tag', 'finish_tag', 'seq', 'enqueued_at', 'granted', 'cancelled', 'notify')
+
+    def __init__(self, tenant, priority, start_tag, finish_tag, seq, notify):
+        self.tenant = tenant
+        self.priority = priority
+        self.start_tag = start_tag
+        self.finish_tag = finish_tag
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+        self.cancelled = False
+        self.notify = notify
+
+    def sort_key(self):
+        # 優先度は重みとして仮想終了時刻に反映済みなので、ここでは比較しない
+        return (self.finish_tag, self.seq)
+
+    def __lt__(self, other):
+        return self.sort_key() < other.sort_key()
+
+
+class FairScheduler:
+    """
+    slots: 全体の同時実行数
+    tenant_max_concurrency: 1テナントあたりの同時実行数の上限
+    weights: 優先度ごとの重み
+    tenant_weights: テナントごとの重み (指定がなければ 1.0)
+    フロー (テナント, 優先度) の重みは両者の積。大きいほど仮想時間の進みが遅く、多く実行される
+    """
+
+    def __init__(self, slots=4, tenant_max_concurrency=2, weights=None, tenant_weights=None, wait_samples=1000):
+        self.slots = slots
+        self.tenant_max_concurrency = tenant_max_concurrency
+        self.weights = dict(weights or DEFAULT_PRIORITY_WEIGHTS)
+        self.tenant_weights = dict(tenant_weights or {})
+        self._lock = threading.Lock()
+        self._queue = []  # _Ticket のヒープ (取り消し済みは遅延削除)
+        self._seq = itertools.count()
+        self._virtual_time = 0.0
+        self._flow_finish = {}  # (テナント, 優先度) → 最後に投入したチケットの仮想終了時刻
+        self._running = 0
+        self._tenant_running = {}
+        self._wait_samples = {p: deque(maxlen=wait_samples) for p in PRIORITIES}
+        self._granted_total = {p: 0 for p in PRIORITIES}
+
+    # --- 内部処理 (self._lock を保持して呼ぶ) ---
+
+    def _enqueue(self, tenant, priority, cost, notify):
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority: {priority}")
+        flow = (tenant, priority)
+        weight = self.weights[priority] * self.tenant_weights.get(tenant, 1.0)
+        start_tag = max(self._virtual_time, self._flow_finish.get(flow, 0.0))
+        finish_tag = start_tag + cost / weight
+        self._flow_finish[flow] = finish_tag
+        ticket = _Ticket(tenant, priority, start_tag, finish_tag, next(self._seq), notify)
+        heapq.heappush(self._queue, ticket)
+        self._dispatch()
+        return ticket
+
+    def _dispatch(self):
+        """空き枠があれば、上限に達していないテナントの中から最も仮想終了時刻が早いものに割り当てる"""
+        skipped = []
+        while self._queue and self._running < self.slots:
+            ticket = heapq.heappop(self._queue)
+            if ticket.cancelled:
+                continue
+            if self._tenant_running.get(ticket.tenant, 0) >= self.tenant_max_concurrency:
+                skipped.append(ticket)
+                continue
+            ticket.granted = True
+            self._running += 1
+            self._tenant_running[ticket.tenant] = self._tenant_running.get(ticket.tenant, 0) + 1
+            self._virtual_time = max(self._virtual_time, ticket.start_tag)
+            self._wait_samples[ticket.priority].append(time.monotonic() - ticket.enqueued_at)
+            self._granted_total[ticket.priority] += 1
+            ticket.notify()
+        for ticket in skipped:
+            heapq.heappush(self._queue, ticket)
+
+    def _release(self, ticket):
+        self._running -= 1
+        remaining = self._tenant_running[ticket.tenant] - 1
+        if remaining:
+            self._tenant_running[ticket.tenant] = remaining
+        else:
+            del self._tenant_running[ticket.tenant]
+            # 待ちのないテナントの仮想時刻は覚えておく必要がない
+            if not any(t.tenant == ticket.tenant and not t.cancelled for t in self._queue):
+                for priority in PRIORITIES:
+                    self._flow_finish.pop((ticket.tenant, priority), None)
+        self._dispatch()
+
+    def _cancel_waiting(self, ticket):
+        """待機中のチケットを取り消す。既に割り当て済みだった場合はFalse"""
+        with self._lock:
+            if ticket.granted:
+                return False
+            ticket.cancelled = True
+            return True
+
+    def release(self, ticket):
+        with self._lock:
+            self._release(ticket)
+
+    # --- スレッド用 ---
+
+    def acquire(self, tenant, priority=PRIORITY_INTERACTIVE, cost=1.0, timeout=None, abort=None, poll_interval=1.0):
+        """
+        実行枠が得られるまで待つ。timeout 秒を過ぎるか abort() が True になったら SchedulerTimeout
+        """
+        event = threading.Event()
+        with self._lock:
+            ticket = self._enqueue(tenant, priority, cost, event.set)
+
+        expires_at = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = poll_interval if abort else None
+            if expires_at is not None:
+                remaining = max(0.0, expires_at - time.monotonic())
+                wait = remaining if wait is None else min(wait, remaining)
+            if event.wait(wait):
+                return ticket
+            timed_out = expires_at is not None and time.monotonic() >= expires_at
+            if (timed_out or (abort and abort())) and self._cancel_waiting(ticket):
+                raise SchedulerTimeout(f"No slot for tenant {tenant}")
+            if ticket.granted:
+                return ticket
+
+    @contextmanager
+    def slot(self, tenant, priority=PRIORITY_INTERACTIVE, cost=1.0, timeout=None, abort=None):
+        ticket = self.acquire(tenant, priority, cost, timeout, abort)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    # --- asyncio用 ---
+
+    async def acquire_async(self, tenant, priority=PRIORITY_INTERACTIVE, cost=1.0, timeout=None):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def notify():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        with self._lock:
+            ticket = self._enqueue(tenant, priority, cost, notify)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            if self._cancel_waiting(ticket):
+                raise SchedulerTimeout(f"No slot for tenant {tenant} within {timeout}s")
+        except asyncio.CancelledError:
+            if not self._cancel_waiting(ticket):
+                self.release(ticket)
+            raise
+        return ticket
+
+    @asynccontextmanager
+    async def async_slot(self, tenant, priority=PRIORITY_INTERACTIVE, cost=1.0, timeout=None):
+        ticket = await self.acquire_async(tenant, priority, cost, timeout)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    # --- メトリクス ---
+
+    def stats(self):
+        """キュー長・実行数・優先度別のキュー待ち時間 (秒) を返す"""
+        def percentile(sorted_values, q):
+            if not sorted_values:
+                return None
+            return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+        with self._lock:
+            waiting = [t for t in self._queue if not t.cancelled]
+            queue_wait = {}
+            for priority, samples in self._wait_samples.items():
+                values = sorted(samples)
+                queue_wait[priority] = {
+                    "samples": len(values),
+                    "granted_total": self._granted_total[priority],
+                    "p50": percentile(values, 0.50),
+                    "p95": percentile(values, 0.95),
+                    "max": values[-1] if values else None
+                }
+            return {
+                "slots": self.slots,
+                "running": self._running,
+                "tenant_max_concurrency": self.tenant_max_concurrency,
+                "running_by_tenant_count": len(self._tenant_running),
+                "queued": {p: sum(1 for t in waiting if t.priority == p) for p in PRIORITIES},
+                "queue_wait_seconds": queue_wait
+            }
@@ -1,19 +1,19 @@
 import os
 import json
-import requests
 import traceback
 import time
-import pickle
-from flask import Flask, request, jsonify, send_file, session, redirect, url_for
-from youtube_transcript_api import YouTubeTranscriptApi
+import threading
+from flask import Flask, Response, request, jsonify, send_file, session, redirect, url_for, stream_with_context
 from urllib.parse import urlparse, parse_qs
-from google_auth_oauthlib.flow import Flow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from dotenv import load_dotenv
+from cookie_provider import CookieProvider
 
-# .envファイルから環境変数を読み込む
-load_dotenv()
+# 重いSDK (requests, yt_dlp, youtube_transcript_api, google系) は起動時に読み込まない。
+# Renderの無料枠はアイドル後のコールドスタートが遅いため、各ルートの初回利用時に遅延importする。
+
+# .envファイルから環境変数を読み込む (ファイルがある場合のみ dotenv を読み込む)
+if os.path.exists('.env'):
+    from dotenv import load_dotenv
+    load_dotenv()
 
 app = Flask(__name__)
 # セッション管理用の秘密鍵（本来は環境変数などにすべきだが、デモ用に固定値）
@@ -31,25 +31,268 @@ API_VERSION = 'v1'
 # 開発環境用: HTTPSを要求しない設定
 os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
 
+# ディスクキャッシュ (Geminiモデル一覧・Discoveryドキュメント)
+CACHE_DIR = os.environ.get('CACHE_DIR', '.cache')
+GEMINI_MODELS_CACHE_TTL = int(os.environ.get('GEMINI_MODELS_CACHE_TTL', 6 * 60 * 60))
+
+# 字幕ストア (レスポンスには字幕本文ではなくIDを返す)
+TRANSCRIPT_DIR = os.environ.get('TRANSCRIPT_DIR', os.path.join(CACHE_DIR, 'transcripts'))
+
+# Google Tasks の既存タスク索引 (重複追加防止用) のキャッシュ
+TASKS_INDEX_DIR = os.environ.get('TASKS_INDEX_DIR', os.path.join(CACHE_DIR, 'tasks_index'))
+
+# 解析結果の保存先 (SQLite) と、再解析を省略する鮮度
+ANALYSIS_DB_PATH = os.environ.get('ANALYSIS_DB_PATH', os.path.join(CACHE_DIR, 'analyses.db'))
+ANALYSIS_FRESH_TTL = int(os.environ.get('ANALYSIS_FRESH_TTL', 24 * 60 * 60))
+HISTORY_PAGE_SIZE_MAX = 100
+
+# 再生リスト・チャンネル展開の上限と、動画解析の並列数
+PLAYLIST_MAX_ITEMS = int(os.environ.get('PLAYLIST_MAX_ITEMS', 50))
+PLAYLIST_SCAN_MAX = int(os.environ.get('PLAYLIST_SCAN_MAX', 500))
+INGEST_CONCURRENCY = int(os.environ.get('INGEST_CONCURRENCY', 4))
+
+# gunicorn の --timeout (Procfile / Dockerfile と同じ環境変数)。
+# 期限がこれより長いと、部分結果を返す前にワーカーが強制終了されるため、期限はこれより短く抑える
+WORKER_TIMEOUT_SECONDS = float(os.environ.get('GUNICORN_TIMEOUT', 330))
+DEADLINE_MARGIN_SECONDS = 15  # 期限切れから部分結果を返し終えるまでの余裕
+
+# 解析リクエストの期限 (秒)。ヘッダー X-Request-Timeout で短く/長くできるが上限あり
+ANALYZE_DEADLINE_MAX_SECONDS = min(
+    float(os.environ.get('ANALYZE_DEADLINE_MAX_SECONDS', 900)),
+    WORKER_TIMEOUT_SECONDS - DEADLINE_MARGIN_SECONDS
+)
+ANALYZE_DEADLINE_SECONDS = min(float(os.environ.get('ANALYZE_DEADLINE_SECONDS', 300)), ANALYZE_DEADLINE_MAX_SECONDS)
+DEADLINE_HEADER = 'X-Request-Timeout'
+# クライアント切断・期限切れを確認する間隔 (秒)
+DISCONNECT_POLL_INTERVAL = 1.0
+
+# YouTube用Cookie: cookies.txt (なければ環境変数 YOUTUBE_COOKIES) を起動時に一度読み込んで共有する
+COOKIES_FILE = os.environ.get('COOKIES_FILE', 'cookies.txt')
+COOKIES_MATERIALIZED_PATH = os.path.join(CACHE_DIR, 'youtube_cookies.txt')
+COOKIES_CHECK_INTERVAL = float(os.environ.get('COOKIES_CHECK_INTERVAL', 5))
+COOKIES_FAILURE_THRESHOLD = int(os.environ.get('COOKIES_FAILURE_THRESHOLD', 5))
+
+cookie_provider = CookieProvider(
+    source_path=COOKIES_FILE,
+    materialized_path=COOKIES_MATERIALIZED_PATH,
+    check_interval=COOKIES_CHECK_INTERVAL,
+    failure_threshold=COOKIES_FAILURE_THRESHOLD
+)
+
+# 公平スケジューラー: 全体の同時解析数・ユーザーごとの上限・interactive 扱いにする動画数
+SCHEDULER_SLOTS = int(os.environ.get('SCHEDULER_SLOTS', 8))
+SCHEDULER_TENANT_MAX_CONCURRENCY = int(os.environ.get('SCHEDULER_TENANT_MAX_CONCURRENCY', 3))
+INTERACTIVE_MAX_VIDEOS = int(os.environ.get('INTERACTIVE_MAX_VIDEOS', 3))
+
+_analysis_scheduler = None
+_analysis_scheduler_lock = threading.Lock()
+
+def get_analysis_scheduler():
+    """字幕取得・Gemini呼び出しの実行枠を配る公平スケジューラー (初回利用時に作成)"""
+    global _analysis_scheduler
+    if _analysis_scheduler is None:
+        with _analysis_scheduler_lock:
+            if _analysis_scheduler is None:
+                from scheduler import FairScheduler
+                _analysis_scheduler = FairScheduler(
+                    slots=SCHEDULER_SLOTS,
+                    tenant_max_concurrency=SCHEDULER_TENANT_MAX_CONCURRENCY
+                )
+    return _analysis_scheduler
+
+def request_priority(item_count):
+    """少数の動画は interactive、再生リスト等の大量投入は bulk として扱う"""
+    return 'interactive' if item_count <= INTERACTIVE_MAX_VIDEOS else 'bulk'
+
+class DeadlineExceeded(Exception):
+    """期限切れ・クライアント切断で処理を打ち切るときに送出する"""
+
+class Deadline:
+    """
+    リクエスト単位の期限と取り消しフラグ。処理の各段階で check() を呼んで打ち切る
+    seconds=None なら期限なし (取り消しのみ有効)
+    """
+
+    def __init__(self, seconds=None):
+        self.expires_at = None if seconds is None else time.monotonic() + seconds
+        self._cancelled = threading.Event()
+
+    def remaining(self):
+        """残り秒数 (期限なしならNone)"""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def expired(self):
+        return self.cancelled or self.remaining() == 0.0
+
+    def check(self):
+        if self.expired():
+            raise DeadlineExceeded("cancelled" if self.cancelled else "deadline exceeded")
+
+    def timeout(self, cap=None):
+        """HTTPリクエストに渡すタイムアウト (残り時間と cap の小さい方)"""
+        remaining = self.remaining()
+        if remaining is None:
+            return cap
+        if cap is None:
+            return max(remaining, 0.001)
+        return max(min(cap, remaining), 0.001)
+
+def get_request_deadline(headers):
+    """リクエストヘッダーから期限を作る (なければサーバーのデフォルト)"""
+    seconds = ANALYZE_DEADLINE_SECONDS
+    value = headers.get(DEADLINE_HEADER)
+    if value:
+        seconds = float(value)
+        if seconds <= 0:
+            raise ValueError(f"{DEADLINE_HEADER} must be positive")
+    return Deadline(min(seconds, ANALYZE_DEADLINE_MAX_SECONDS))
+
+def client_disconnected(environ):
+    """
+    WSGIサーバーのソケットを覗いてクライアントが切断したか調べる。
+    (gunicorn / werkzeug 開発サーバーのみ対応。分からない場合はFalse)
+    """
+    import socket
+    sock = environ.get('gunicorn.socket') or environ.get('werkzeug.socket')
+    if sock is None:
+        return False
+    try:
+        return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+    except (BlockingIOError, InterruptedError):
+        return False
+    except (OSError, ValueError):
+        return True
+
+# 起動後にバックグラウンドで読み込んでおく重いモジュール
+WARMUP_MODULES = [
+    'requests',
+    'youtube_transcript_api',
+    'yt_dlp',
+    'google.oauth2.credentials',
+    'google.auth.transport.requests',
+    'google_auth_oauthlib.flow',
+    'googleapiclient.discovery',
+]
+
+def _warmup_heavy_modules():
+    """
+    起動直後に重いモジュールをバックグラウンドで読み込む。
+    初回リクエストで import 待ちが発生しないようにするため (失敗しても無視)
+    """
+    import importlib
+    started = time.time()
+    for name in WARMUP_MODULES:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            print(f"Warm-up import failed for {name}: {e}")
+    print(f"Warm-up imports finished in {time.time() - started:.2f}s")
+
+def start_background_warmup():
+    """環境変数 WARMUP_IMPORTS=0 で無効化できる"""
+    if os.environ.get('WARMUP_IMPORTS', '1') == '0':
+        return None
+    t = threading.Thread(target=_warmup_heavy_modules, name='warmup-imports', daemon=True)
+    t.start()
+    return t
+
+def _read_cache_json(name, max_age=None):
+    """CACHE_DIR内のJSONキャッシュを読む。期限切れ・破損時はNone"""
+    path = os.path.join(CACHE_DIR, name)
+    try:
+        if max_age is not None and time.time() - os.path.getmtime(path) > max_age:
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _write_cache_json(name, data):
+    """CACHE_DIRにJSONを書き込む (一時ファイル経由で置き換え)"""
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        path = os.path.join(CACHE_DIR, name)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Failed to write cache {name}: {e}")
+
+_discovery_doc = None
+
+def get_discovery_document():
+    """
+    Google Tasks APIのDiscoveryドキュメントを取得する。
+    メモリ → ディスク (CACHE_DIR) → ライブラリ同梱/ネットワーク の順で探す
+    """
+    global _discovery_doc
+    if _discovery_doc is not None:
+        return _discovery_doc
+
+    cache_name = f"discovery_{API_SERVICE_NAME}_{API_VERSION}.json"
+    doc = _read_cache_json(cache_name)
+    if doc is None:
+        doc_text = None
+        try:
+            from googleapiclient.discovery_cache import get_static_doc
+            doc_text = get_static_doc(API_SERVICE_NAME, API_VERSION)
+        except ImportError:
+            pass
+        if not doc_text:
+            import requests
+            url = f"https://{API_SERVICE_NAME}.googleapis.com/$discovery/rest?version={API_VERSION}"
+            res = requests.get(url, timeout=15)
+            res.raise_for_status()
+            doc_text = res.text
+        doc = json.loads(doc_text)
+        _write_cache_json(cache_name, doc)
+
+    _discovery_doc = doc
+    return doc
+
 def get_google_service():
     """
     保存された認証情報からGoogle Tasks APIサービスを構築する
     """
-    creds = None
-    if 'credentials' in session:
-        # セッションから復元（簡易実装: 本番ではDB等推奨）
-        import google.oauth2.credentials
-        creds_data = session['credentials']
-        creds = google.oauth2.credentials.Credentials(**creds_data)
+    if 'credentials' not in session:
+        # 未連携なら google 系SDKを読み込む必要はない
+        return None
+
+    from googleapiclient.discovery import build_from_document
+
+    # セッションから復元（簡易実装: 本番ではDB等推奨）
+    creds = load_google_credentials(session)
+    if not creds:
+        return None
+    return build_from_document(get_discovery_document(), credentials=creds)
+
+def load_google_credentials(session_data):
+    """
+    セッション(dict)の認証情報を復元し、期限切れならリフレッシュする。
+    リフレッシュした場合はセッションの認証情報も更新する。無効ならNone
+    """
+    import google.oauth2.credentials
+    from google.auth.transport.requests import Request
+
+    creds = google.oauth2.credentials.Credentials(**session_data['credentials'])
     
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
             creds.refresh(Request())
-            session['credentials'] = credentials_to_dict(creds)
+            session_data['credentials'] = credentials_to_dict(creds)
         else:
             return None
-            
-    return build(API_SERVICE_NAME, API_VERSION, credentials=creds)
+    return creds
 
 def credentials_to_dict(credentials):
     return {
@@ -61,16 +304,14 @@ def credentials_to_dict(credentials):
         'scopes': credentials.scopes
     }
 
-import json
-
-# ... (imports)
-
 def get_flow(state=None):
     """
     Flowオブジェクトを作成するヘルパー関数
     環境変数 GOOGLE_CLIENT_SECRET_JSON があればそれを優先し、
     なければファイル client_secret.json を使用する。
     """
+    from google_auth_oauthlib.flow import Flow
+
     # 1. 環境変数から読み込み（クラウド用）
     client_config_json = os.environ.get('GOOGLE_CLIENT_SECRET_JSON')
     if client_config_json:
@@ -157,9 +398,146 @@ def get_tasklists():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# ---------------------------------------------------------------
+# Google Tasks の既存タスク索引
+# 同じタスクを二重に追加しないよう、タスクリストの既存タスクをローカルにキャッシュする。
+# キーは Google が返す実際のタスクリストID (アカウントごとに異なる)。@default などの別名は
+# アカウント間で共通なので、キーにする前に必ず解決する。
+# 形式: {"tasklist_id", "tasklist_etag", "tasklist_updated", "synced_at", "tasks": {id: {"title", "notes", "status"}}}
+# ---------------------------------------------------------------
+
+_tasks_index_locks = {}
+_tasks_index_locks_guard = threading.Lock()
+
+def get_tasks_index_lock(tasklist_id):
+    """同じタスクリストへの同時エクスポートで重複が出ないよう、リストごとに直列化する"""
+    with _tasks_index_locks_guard:
+        return _tasks_index_locks.setdefault(tasklist_id, threading.Lock())
+
+def normalize_task_title(title):
+    """重複判定用にタイトルを正規化する (全角半角・大文字小文字・空白の違いを無視)"""
+    import unicodedata
+    title = unicodedata.normalize('NFKC', title or '').casefold()
+    return ' '.join(title.split())
+
+def _tasks_index_path(tasklist_id):
+    import hashlib
+    return os.path.join(TASKS_INDEX_DIR, hashlib.sha256(tasklist_id.encode('utf-8')).hexdigest() + '.json')
+
+def is_tasklist_alias(tasklist_id):
+    """@default のような、アカウントごとに指す先が変わる別名かどうか"""
+    return tasklist_id.startswith('@')
+
+def load_tasks_index(tasklist_id):
+    """キャッシュ済みの索引を返す (なければNone)"""
+    if is_tasklist_alias(tasklist_id):
+        return None
+    try:
+        with open(_tasks_index_path(tasklist_id), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # 別のリストの索引 (別名をキーにしていた古いキャッシュなど) は使わない
+    if index.get('tasklist_id') != tasklist_id:
+        return None
+    return index
+
+def save_tasks_index(tasklist_id, index):
+    if is_tasklist_alias(tasklist_id):
+        raise ValueError(f"Tasks index must be keyed by a resolved tasklist id: {tasklist_id}")
+    try:
+        os.makedirs(TASKS_INDEX_DIR, exist_ok=True)
+        _write_atomic(_tasks_index_path(tasklist_id), json.dumps(index, ensure_ascii=False).encode('utf-8'))
+    except OSError as e:
+        print(f"Failed to save tasks index: {e}")
+
+def new_tasks_index(tasklist_id):
+    return {"tasklist_id": tasklist_id, "tasklist_etag": None, "tasklist_updated": None, "synced_at": None, "tasks": {}}
+
+def tasks_sync_timestamp():
+    """次回の差分取得 (updatedMin) に使う時刻。時計のずれを考慮して少し前にする"""
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(time.time() - 60))
+
+def merge_task_changes(index, items):
+    """tasks.list の結果を索引に反映する (削除済みのタスクは取り除く)"""
+    for item in items:
+        if item.get('deleted'):
+            index['tasks'].pop(item['id'], None)
+        else:
+            record_task_in_index(index, item)
+
+def record_task_in_index(index, task_resource, title_index=None):
+    if title_index is not None:
+        title_index[normalize_task_title(task_resource.get('title'))] = task_resource['id']
+    index['tasks'][task_resource['id']] = {
+        "title": task_resource.get('title', ''),
+        "notes": task_resource.get('notes', ''),
+        "status": task_resource.get('status', 'needsAction')
+    }
+
+def build_title_index(index):
+    """正規化タイトル → タスクID の辞書を作る"""
+    return {normalize_task_title(t['title']): task_id for task_id, t in index['tasks'].items()}
+
+def plan_task_export(index, title_index, task, on_duplicate='update'):
+    """
+    追加するタスクを既存タスクと照合し、(action, 既存タスクID) を返す
+    action: 'insert' / 'skip' / 'update' (メモだけ異なる未完了タスクは更新する)
+    """
+    task_id = title_index.get(normalize_task_title(task.get('title')))
+    if not task_id:
+        return 'insert', None
+    existing = index['tasks'][task_id]
+    if on_duplicate == 'update' and existing['status'] != 'completed' \
+            and (task.get('notes') or '') != (existing.get('notes') or ''):
+        return 'update', task_id
+    return 'skip', task_id
+
+def resolve_tasklist_id(service, tasklist_id):
+    """@default などの別名を実際のタスクリストIDに解決する (別名でなければそのまま返す)"""
+    if not is_tasklist_alias(tasklist_id):
+        return tasklist_id
+    return service.tasklists().get(tasklist=tasklist_id).execute()['id']
+
+def sync_tasks_index(service, tasklist_id):
+    """
+    タスクリストの既存タスクを索引に同期する。
+    タスクリストの更新日時が前回と同じならキャッシュをそのまま使い、
+    変わっていれば前回同期以降の変更だけ (updatedMin) をページングして取得する
+    索引は解決済みのタスクリストID (index['tasklist_id']) で保存すること
+    """
+    tasklist = service.tasklists().get(tasklist=tasklist_id).execute()
+    tasklist_id = tasklist['id']
+    index = load_tasks_index(tasklist_id)
+    if index and index.get('tasklist_updated') == tasklist.get('updated'):
+        return index
+
+    synced_at = tasks_sync_timestamp()
+    params = {'tasklist': tasklist_id, 'maxResults': 100, 'showCompleted': True, 'showHidden': True}
+    if index and index.get('synced_at'):
+        params.update(updatedMin=index['synced_at'], showDeleted=True)
+    else:
+        index = new_tasks_index(tasklist_id)
+
+    while True:
+        response = service.tasks().list(**params).execute()
+        merge_task_changes(index, response.get('items', []))
+        if not response.get('nextPageToken'):
+            break
+        params['pageToken'] = response['nextPageToken']
+
+    index['tasklist_etag'] = tasklist.get('etag')
+    index['tasklist_updated'] = tasklist.get('updated')
+    index['synced_at'] = synced_at
+    return index
+
 @app.route('/api/google/tasks', methods=['POST'])
 def add_tasks():
-    """タスクを追加する"""
+    """
+    タスクを追加する。既存タスクと同じタイトルのものは追加せず、
+    結果の action に inserted / skipped / updated を返す
+    on_duplicate: 'update' (デフォルト: メモが違えば更新) / 'skip' (常にスキップ)
+    """
     service = get_google_service()
     if not service:
         return jsonify({"error": "Not authenticated"}), 401
@@ -167,26 +545,56 @@ def add_tasks():
     data = request.json
     tasklist_id = data.get('tasklist_id')
     tasks = data.get('tasks', []) # [{'title': '...', 'notes': '...'}]
+    on_duplicate = data.get('on_duplicate', 'update')
     
     if not tasklist_id or not tasks:
         return jsonify({"error": "Missing tasklist_id or tasks"}), 400
-        
-    results = []
-    print(f"Adding {len(tasks)} tasks to list {tasklist_id}...")
-    
-    for task in tasks:
+    if on_duplicate not in ('update', 'skip'):
+        return jsonify({"error": "on_duplicate must be 'update' or 'skip'"}), 400
+
+    try:
+        # 索引とロックはアカウント固有のIDで管理する (@default のままだと別アカウントと共有される)
+        tasklist_id = resolve_tasklist_id(service, tasklist_id)
+    except Exception as e:
+        print(f"Error fetching existing tasks: {e}")
+        return jsonify({"error": f"既存タスクの取得に失敗しました: {e}"}), 500
+
+    with get_tasks_index_lock(tasklist_id):
         try:
-            body = {
-                'title': task.get('title'),
-                'notes': task.get('notes', '')
-            }
-            result = service.tasks().insert(tasklist=tasklist_id, body=body).execute()
-            results.append({"status": "success", "id": result.get('id'), "title": result.get('title')})
-            # レート制限回避のため少しウェイト
-            time.sleep(0.5) 
+            index = sync_tasks_index(service, tasklist_id)
         except Exception as e:
-            print(f"Error adding task: {e}")
-            results.append({"status": "error", "error": str(e), "title": task.get('title')})
+            print(f"Error fetching existing tasks: {e}")
+            return jsonify({"error": f"既存タスクの取得に失敗しました: {e}"}), 500
+
+        title_index = build_title_index(index)
+        results = []
+        print(f"Adding {len(tasks)} tasks to list {tasklist_id}...")
+        
+        for task in tasks:
+            try:
+                action, existing_id = plan_task_export(index, title_index, task, on_duplicate)
+                body = {
+                    'title': task.get('title'),
+                    'notes': task.get('notes', '')
+                }
+                if action == 'skip':
+                    results.append({"status": "success", "action": "skipped", "id": existing_id, "title": task.get('title')})
+                    continue
+                if action == 'update':
+                    result = service.tasks().patch(tasklist=tasklist_id, task=existing_id, body={'notes': body['notes']}).execute()
+                    results.append({"status": "success", "action": "updated", "id": result.get('id'), "title": result.get('title')})
+                else:
+                    result = service.tasks().insert(tasklist=tasklist_id, body=body).execute()
+                    results.append({"status": "success", "action": "inserted", "id": result.get('id'), "title": result.get('title')})
+                # 同じリクエスト内の重複も防ぐため、すぐ索引に反映する
+                record_task_in_index(index, result, title_index)
+                # レート制限回避のため少しウェイト
+                time.sleep(0.5) 
+            except Exception as e:
+                print(f"Error adding task: {e}")
+                results.append({"status": "error", "error": str(e), "title": task.get('title')})
+
+        save_tasks_index(tasklist_id, index)
             
     return jsonify(results)
 
@@ -237,9 +645,14 @@ def extract_text_safe(transcript_data):
 def get_available_gemini_models(api_key):
     """
     利用可能なGeminiモデルを動的に取得し、優先順位順にリストで返す
+    結果は GEMINI_MODELS_CACHE_TTL 秒の間ディスクにキャッシュする
     """
-    # キャッシュなどを検討しても良いが、一旦毎回確認（安全重視）
+    cached = _read_cache_json('gemini_models.json', max_age=GEMINI_MODELS_CACHE_TTL)
+    if cached:
+        return cached
+
     try:
+        import requests
         url = f"https://generativelanguage.googleapis.com/v1beta/models?key={api_key}"
         response = requests.get(url)
         
@@ -273,52 +686,64 @@ def get_available_gemini_models(api_key):
             if model_name not in sorted_models:
                 sorted_models.append(model_name)
 
+        # 取得に成功した一覧だけをキャッシュする (空・エラー時はキャッシュしない)
+        _write_cache_json('gemini_models.json', sorted_models)
         return sorted_models
 
     except Exception as e:
         print(f"Error checking models: {e}")
         return []
 
-def call_gemini_api(prompt_text, api_key):
-    """
-    Gemini APIを呼び出す共通関数
-    """
-    print("Calling Gemini API...")
+# Geminiモデル一覧が取得できなかった場合に試すモデル
+GEMINI_FALLBACK_MODELS = [
+    "models/gemini-1.5-flash",
+    "models/gemini-1.5-flash-001",
+    "models/gemini-pro",
+    "models/gemini-1.0-pro"
+]
+
+def get_gemini_models_to_try(api_key):
+    """呼び出しを試すモデルを優先順位順に返す"""
     available_models = get_available_gemini_models(api_key)
-    
-    if available_models:
-        models_to_try = available_models
-    else:
-        models_to_try = [
-            "models/gemini-1.5-flash",
-            "models/gemini-1.5-flash-001",
-            "models/gemini-pro",
-            "models/gemini-1.0-pro"
-        ]
+    models = available_models if available_models else GEMINI_FALLBACK_MODELS
+    return [m if m.startswith("models/") else f"models/{m}" for m in models if m]
 
+def build_gemini_request(prompt_text, model, api_key):
+    """generateContent の (URL, payload) を返す"""
+    api_url = f"https://generativelanguage.googleapis.com/v1beta/{model}:generateContent?key={api_key}"
     payload = {
         "contents": [{"parts": [{"text": prompt_text}]}],
         "generationConfig": {"response_mime_type": "application/json"}
     }
-    
-    last_error = None
+    return api_url, payload
 
-    for model in models_to_try:
-        if not model: continue
-        if not model.startswith("models/"): model = f"models/{model}"
+def parse_gemini_response(result_json):
+    """generateContent のレスポンスから出力JSONを取り出す"""
+    if 'candidates' in result_json and result_json['candidates']:
+        content_text = result_json['candidates'][0]['content']['parts'][0]['text']
+        return json.loads(content_text)
+    raise Exception("No candidates in response")
+
+def call_gemini_api(prompt_text, api_key, deadline=None):
+    """
+    Gemini APIを呼び出す共通関数
+    deadline を過ぎたら DeadlineExceeded を送出する
+    """
+    import requests
+    print("Calling Gemini API...")
+    deadline = deadline or Deadline()
 
+    last_error = None
+
+    for model in get_gemini_models_to_try(api_key):
+        deadline.check()
         try:
             print(f"Trying model: {model}...")
-            api_url = f"https://generativelanguage.googleapis.com/v1beta/{model}:generateContent?key={api_key}"
-            response = requests.post(api_url, json=payload, headers={'Content-Type': 'application/json'})
+            api_url, payload = build_gemini_request(prompt_text, model, api_key)
+            response = requests.post(api_url, json=payload, headers={'Content-Type': 'application/json'}, timeout=deadline.timeout())
             
             if response.status_code == 200:
-                result_json = response.json()
-                if 'candidates' in result_json and result_json['candidates']:
-                    content_text = result_json['candidates'][0]['content']['parts'][0]['text']
-                    return json.loads(content_text)
-                else:
-                    raise Exception("No candidates in response")
+                return parse_gemini_response(response.json())
             elif response.status_code == 429:
                 print(f"Model {model} quota exceeded. Trying next...")
                 last_error = f"Quota exceeded for {model}"
@@ -329,268 +754,245 @@ def call_gemini_api(prompt_text, api_key):
         except Exception as e:
             print(f"Error model {model}: {e}")
             last_error = f"{e} (Traceback: {traceback.format_exc()})"
-            
+
+    deadline.check()
     raise Exception(f"All models failed. Last error: {last_error}")
 
-def process_single_video(url, api_key, provided_transcript=None):
+# Invidious API (第3の矢: IPブロック回避) のインスタンス
+INVIDIOUS_INSTANCES = [
+    "https://inv.tux.pizza",
+    "https://vid.puffyan.us",
+    "https://inv.nadeko.net",
+    "https://invidious.jing.rocks",
+    "https://yt.artemislena.eu",
+    "https://invidious.flokinet.to",
+    "https://invidious.privacydev.net", 
+    "https://iv.ggtyler.dev"
+]
+
+def vtt_to_text(lines):
+    """WebVTT to Text (簡易パーサー): タイムコード等を除き、重複行を除去して連結する"""
+    found_text = ""
+    seen_lines = set()
+    for line in lines:
+        line = line.strip()
+        if not line: continue
+        if line == 'WEBVTT': continue
+        if '-->' in line: continue
+        if line.isdigit(): continue # 行番号
+        # 重複排除しつつテキスト化
+        if line not in seen_lines:
+            found_text += line + " "
+            seen_lines.add(line)
+    return found_text
+
+def pick_invidious_caption(captions):
+    """日本語優先、なければ英語のキャプションを返す"""
+    for lang in ('ja', 'en'):
+        for cap in captions:
+            if cap.get('language') == lang:
+                return cap
+    return None
+
+def invidious_caption_url(instance, caption):
+    cap_path = caption.get('url')
+    return f"{instance}{cap_path}" if cap_path.startswith('/') else f"{instance}/{cap_path}"
+
+def fetch_transcript_from_youtube(url, video_id, deadline=None):
     """
-    単一の動画を解析する (Map処理)
-    provided_transcript: クライアント側ですでに取得した字幕があればこれを使う
+    YouTubeから直接字幕を取得する (youtube-transcript-api → yt-dlp)
+    取得できなければ空文字を返す。ライブラリ呼び出しは中断できないので、段階の間で期限を確認する
     """
-    print(f"Processing URL: {url}")
-    video_id = extract_video_id(url)
-    if not video_id:
-        return {"error": "Invalid URL", "url": url}
+    from youtube_transcript_api import YouTubeTranscriptApi
+    deadline = deadline or Deadline()
 
     transcript_text = ""
-    
-    # 0. クライアント提供の字幕があれば優先使用 (サーバーサイドブロック回避の切り札)
-    if provided_transcript:
-        print("Using provided transcript from client (skipping server-side fetch)")
-        transcript_text = provided_transcript
-    
-    # 以下、サーバーサイド取得ロジック (クライアント取得がなかった場合のみ)
-    if not transcript_text:
-        cookies_file_path = None
-    
-        # Cookiesの準備
-        if os.path.exists('cookies.txt'):
-             cookies_file_path = 'cookies.txt'
-        elif os.environ.get('YOUTUBE_COOKIES'):
-            try:
-                import tempfile
-                with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.txt') as tf:
-                    tf.write(os.environ.get('YOUTUBE_COOKIES'))
-                    cookies_file_path = tf.name
-                print(f"Using cookies from env: {cookies_file_path}")
-            except Exception as e:
-                print(f"Failed to create cookies file: {e}")
+    # 起動時に読み込んだCookieを使う (cookies.txt が更新されていれば読み込み直される)
+    cookies_file_path = cookie_provider.path()
 
-        try:
-            # 方法A: youtube-transcript-api (既存)
-            print("Attempting youtube-transcript-api...")
-            yt_instance = YouTubeTranscriptApi()
-            raw_data = None
+    try:
+        # 方法A: youtube-transcript-api (既存)
+        print("Attempting youtube-transcript-api...")
+        yt_instance = YouTubeTranscriptApi()
+        raw_data = None
+        
+        methods = [
+            lambda: yt_instance.list_transcripts(video_id, cookies=cookies_file_path).find_transcript(['ja', 'en']).fetch(),
+            lambda: yt_instance.get_transcript(video_id, cookies=cookies_file_path),
+            lambda: YouTubeTranscriptApi.get_transcript(video_id, languages=['ja', 'en'], cookies=cookies_file_path)
+        ]
+        
+        for method in methods:
+            try:
+                data = method()
+                if hasattr(data, 'find_transcript'): 
+                     try: t = data.find_transcript(['ja', 'en']); raw_data = t.fetch()
+                     except: raw_data = next(iter(data)).fetch()
+                else:
+                     raw_data = data
+                
+                if raw_data: break
+            except: continue
             
-            methods = [
-                lambda: yt_instance.list_transcripts(video_id, cookies=cookies_file_path).find_transcript(['ja', 'en']).fetch(),
-                lambda: yt_instance.get_transcript(video_id, cookies=cookies_file_path),
-                lambda: YouTubeTranscriptApi.get_transcript(video_id, languages=['ja', 'en'], cookies=cookies_file_path)
-            ]
+        if raw_data:
+            transcript_text = extract_text_safe(raw_data)
+        
+        # 方法B: yt-dlp (フォールバック)
+        if not transcript_text and not deadline.expired():
+            print("youtube-transcript-api failed, trying yt-dlp...")
+            import yt_dlp
             
-            for method in methods:
-                try:
-                    data = method()
-                    if hasattr(data, 'find_transcript'): 
-                         try: t = data.find_transcript(['ja', 'en']); raw_data = t.fetch()
-                         except: raw_data = next(iter(data)).fetch()
-                    else:
-                         raw_data = data
-                    
-                    if raw_data: break
-                except: continue
-                
-            if raw_data:
-                transcript_text = extract_text_safe(raw_data)
+            ydl_opts = {
+                'skip_download': True,
+                'writesubtitles': True,
+                'writeautomaticsub': True,
+                'subtitleslangs': ['ja', 'en'],
+                'subtitlesformat': 'json3', # JSON形式で取得
+                'quiet': False, # ログ出力有効化
+                'verbose': True, # デバッグモード
+                # Cookieは cookiefile ではなく共有の CookieJar から渡す (ファイルへの書き戻しを避ける)
+                'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+                'http_headers': {
+                    'Referer': 'https://www.youtube.com/',
+                    'Accept-Language': 'ja-JP,ja;q=0.9,en-US;q=0.8,en;q=0.7'
+                },
+                'nocheckcertificate': True,
+                'socket_timeout': deadline.timeout(30),
+            }
             
-            # 方法B: yt-dlp (フォールバック)
-            if not transcript_text:
-                print("youtube-transcript-api failed, trying yt-dlp...")
-                import yt_dlp
-                
-                ydl_opts = {
-                    'skip_download': True,
-                    'writesubtitles': True,
-                    'writeautomaticsub': True,
-                    'subtitleslangs': ['ja', 'en'],
-                    'subtitlesformat': 'json3', # JSON形式で取得
-                    'quiet': False, # ログ出力有効化
-                    'verbose': True, # デバッグモード
-                    'cookiefile': cookies_file_path,
-                    'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                    'http_headers': {
-                        'Referer': 'https://www.youtube.com/',
-                        'Accept-Language': 'ja-JP,ja;q=0.9,en-US;q=0.8,en;q=0.7'
-                    },
-                    'nocheckcertificate': True,
-                }
-                
-                try:
-                    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                        info = ydl.extract_info(url, download=False)
-                        # 字幕データを探す
-                        import json
-                        
-                        # 自動字幕と手動字幕の両方を探す
-                        subtitles = info.get('subtitles', {}) or info.get('automatic_captions', {})
+            try:
+                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                    cookie_provider.apply_to(ydl.cookiejar)
+                    info = ydl.extract_info(url, download=False)
+                    # 字幕データを探す
+                    
+                    # 自動字幕と手動字幕の両方を探す
+                    subtitles = info.get('subtitles', {}) or info.get('automatic_captions', {})
+                    
+                    target_lang = None
+                    if 'ja' in subtitles: target_lang = 'ja'
+                    elif 'en' in subtitles: target_lang = 'en'
+                    else: 
+                         # 他の言語でもあれば使う
+                         for lang in subtitles:
+                             if lang.startswith('ja') or lang.startswith('en'):
+                                 target_lang = lang
+                                 break
+                         if not target_lang and subtitles:
+                             target_lang = list(subtitles.keys())[0]
+
+                    if target_lang:
+                        # JSON3形式の字幕URLを取得
+                        subs_list = subtitles[target_lang]
+                        json3_url = next((s['url'] for s in subs_list if s.get('ext') == 'json3'), None)
                         
-                        target_lang = None
-                        if 'ja' in subtitles: target_lang = 'ja'
-                        elif 'en' in subtitles: target_lang = 'en'
-                        else: 
-                             # 他の言語でもあれば使う
-                             for lang in subtitles:
-                                 if lang.startswith('ja') or lang.startswith('en'):
-                                     target_lang = lang
-                                     break
-                             if not target_lang and subtitles:
-                                 target_lang = list(subtitles.keys())[0]
-
-                        if target_lang:
-                            # JSON3形式の字幕URLを取得
-                            subs_list = subtitles[target_lang]
-                            json3_url = next((s['url'] for s in subs_list if s.get('ext') == 'json3'), None)
-                            
-                            if not json3_url:
-                                json3_url = subs_list[0]['url'] # とりあえず最初のURL
-                                
-                            print(f"Fetching subtitles from: {json3_url}")
-                            # ファイルダウンロード方式へ移行（確実性のため）
+                        if not json3_url:
+                            json3_url = subs_list[0]['url'] # とりあえず最初のURL
                             
-                    # 再度 yt-dlp (ファイルダウンロード方式)
-                    print("Trying yt-dlp file download mode...")
-                    import tempfile
-                    with tempfile.TemporaryDirectory() as tmpdir:
-                        out_tmpl = os.path.join(tmpdir, '%(id)s')
-                        ydl_opts['outtmpl'] = out_tmpl
+                        print(f"Fetching subtitles from: {json3_url}")
+                        # ファイルダウンロード方式へ移行（確実性のため）
                         
-                        try:
-                            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                                ydl.download([url])
-                            
-                            # 生成されたファイルを探索 (.ja.vtt, .en.vtt など)
-                            found_text = ""
-                            for filename in os.listdir(tmpdir):
-                                if filename.endswith('.vtt'):
-                                    print(f"Found subtitle file: {filename}")
-                                    # vttを簡易パース
-                                    with open(os.path.join(tmpdir, filename), 'r', encoding='utf-8') as f:
-                                        lines = f.readlines()
-                                        seen_lines = set() # 重複除去
-                                        for line in lines:
-                                            line = line.strip()
-                                            if not line: continue
-                                            if line == 'WEBVTT': continue
-                                            if '-->' in line: continue
-                                            if line.isdigit(): continue # 行番号
-                                            if line not in seen_lines:
-                                                found_text += line + " "
-                                                seen_lines.add(line)
-                                    break # 1つ見つかればOK
-                            
-                            transcript_text = found_text
-                            
-                        except Exception as e:
-                            print(f"yt-dlp download failed: {e}")
-                            traceback.print_exc()
+                # 再度 yt-dlp (ファイルダウンロード方式)
+                deadline.check()
+                print("Trying yt-dlp file download mode...")
+                import tempfile
+                with tempfile.TemporaryDirectory() as tmpdir:
+                    out_tmpl = os.path.join(tmpdir, '%(id)s')
+                    ydl_opts['outtmpl'] = out_tmpl
+                    
+                    try:
+                        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                            cookie_provider.apply_to(ydl.cookiejar)
+                            ydl.download([url])
+                        
+                        # 生成されたファイルを探索 (.ja.vtt, .en.vtt など)
+                        found_text = ""
+                        for filename in os.listdir(tmpdir):
+                            if filename.endswith('.vtt'):
+                                print(f"Found subtitle file: {filename}")
+                                # vttを簡易パース
+                                with open(os.path.join(tmpdir, filename), 'r', encoding='utf-8') as f:
+                                    found_text = vtt_to_text(f.readlines())
+                                break # 1つ見つかればOK
+                        
+                        transcript_text = found_text
+                        
+                    except Exception as e:
+                        print(f"yt-dlp download failed: {e}")
+                        traceback.print_exc()
 
-                except Exception as e:
-                    print(f"yt-dlp info extraction failed: {e}")
+            except DeadlineExceeded:
+                print("Deadline exceeded during yt-dlp")
+            except Exception as e:
+                print(f"yt-dlp info extraction failed: {e}")
 
-        except Exception as e:
-            print(f"Subtitle extraction overall failed: {e}")
-            traceback.print_exc()
+    except Exception as e:
+        print(f"Subtitle extraction overall failed: {e}")
+        traceback.print_exc()
 
-        # 一時ファイルの削除
-        if cookies_file_path and os.path.exists(cookies_file_path) and os.environ.get('YOUTUBE_COOKIES'):
-                try: os.unlink(cookies_file_path)
-                except: pass
+    # 期限切れで打ち切った場合はCookieの問題とは限らないので記録しない
+    if transcript_text or not deadline.expired():
+        cookie_provider.record_result(bool(transcript_text))
 
-    # 方法C: Invidious API (第3の矢: IPブロック回避)
-    if not transcript_text:
-        print("yt-dlp failed. Trying Invidious API fallback...")
-        # インスタンスリストを拡充
-        invidious_instances = [
-            "https://inv.tux.pizza",
-            "https://vid.puffyan.us",
-            "https://inv.nadeko.net",
-            "https://invidious.jing.rocks",
-            "https://yt.artemislena.eu",
-            "https://invidious.flokinet.to",
-            "https://invidious.privacydev.net", 
-            "https://iv.ggtyler.dev"
-        ]
-        
-        # ランダムシャッフルして負荷分散（毎回同じ順序だと最初が落ちていると遅い）
-        import random
-        random.shuffle(invidious_instances)
-        
-        for instance in invidious_instances:
-            try:
-                print(f"Trying Invidious instance: {instance}")
-                
-                # 動画メタデータからキャプション情報を得る
-                meta_url = f"{instance}/api/v1/videos/{video_id}"
-                meta_res = requests.get(meta_url, timeout=15) # タイムアウト延長
-                
-                if meta_res.status_code != 200:
-                    print(f"  -> Meta fetch failed: {meta_res.status_code}")
-                    continue
-                    
-                meta_data = meta_res.json()
-                captions = meta_data.get('captions', [])
-                
-                target_caption = None
-                # 日本語優先
-                for cap in captions:
-                    if cap.get('language') == 'ja':
-                        target_caption = cap
-                        break
-                # なければ英語
-                if not target_caption:
-                    for cap in captions:
-                        if cap.get('language') == 'en':
-                            target_caption = cap
-                            break
-                            
-                if not target_caption:
-                    print(f"  -> No Japanese/English caption found in {instance}")
-                    continue
-                
-                cap_path = target_caption.get('url')
-                full_cap_url = f"{instance}{cap_path}" if cap_path.startswith('/') else f"{instance}/{cap_path}"
-                
-                print(f"Fetching caption from: {full_cap_url}")
-                cap_res = requests.get(full_cap_url, timeout=15)
+    return transcript_text
+
+def fetch_transcript_from_invidious(video_id, deadline=None):
+    """
+    Invidious API経由で字幕を取得する。取得できなければ空文字を返す
+    """
+    import requests
+    import random
+    deadline = deadline or Deadline()
+
+    # ランダムシャッフルして負荷分散（毎回同じ順序だと最初が落ちていると遅い）
+    invidious_instances = list(INVIDIOUS_INSTANCES)
+    random.shuffle(invidious_instances)
+    
+    for instance in invidious_instances:
+        deadline.check()
+        try:
+            print(f"Trying Invidious instance: {instance}")
+            
+            # 動画メタデータからキャプション情報を得る
+            meta_url = f"{instance}/api/v1/videos/{video_id}"
+            meta_res = requests.get(meta_url, timeout=deadline.timeout(15)) # タイムアウト延長
+            
+            if meta_res.status_code != 200:
+                print(f"  -> Meta fetch failed: {meta_res.status_code}")
+                continue
                 
-                if cap_res.status_code == 200:
-                    vtt_content = cap_res.text
-                    # WebVTT to Text (簡易パーサー)
-                    lines = vtt_content.splitlines()
-                    found_text = ""
-                    seen_lines = set()
-                    for line in lines:
-                        line = line.strip()
-                        if not line: continue
-                        if line == 'WEBVTT': continue
-                        if '-->' in line: continue
-                        if line.isdigit(): continue
-                        # 重複排除しつつテキスト化
-                        if line not in seen_lines:
-                            found_text += line + " "
-                            seen_lines.add(line)
-                    
-                    transcript_text = found_text
-                    if transcript_text:
-                        print(f"Successfully fetched from Invidious ({instance})!")
-                        break
-                else:
-                    print(f"  -> Caption fetch failed: {cap_res.status_code}")
-                    
-            except Exception as e:
-                print(f"Invidious instance {instance} error: {e}")
+            target_caption = pick_invidious_caption(meta_res.json().get('captions', []))
+            if not target_caption:
+                print(f"  -> No Japanese/English caption found in {instance}")
                 continue
+            
+            full_cap_url = invidious_caption_url(instance, target_caption)
+            print(f"Fetching caption from: {full_cap_url}")
+            cap_res = requests.get(full_cap_url, timeout=deadline.timeout(15))
+            
+            if cap_res.status_code == 200:
+                transcript_text = vtt_to_text(cap_res.text.splitlines())
+                if transcript_text:
+                    print(f"Successfully fetched from Invidious ({instance})!")
+                    return transcript_text
+            else:
+                print(f"  -> Caption fetch failed: {cap_res.status_code}")
+                
+        except Exception as e:
+            print(f"Invidious instance {instance} error: {e}")
+            continue
 
-    if not transcript_text:
-        # 詳細なログをサーバーに残すためprint
-        print(f"All methods failed for {url}")
-        return {"error": "Subtitle not found (Server blocked by YouTube. Cookies setup required or invalid).", "url": url}
+    return ""
 
+SUBTITLE_NOT_FOUND_ERROR = "Subtitle not found (Server blocked by YouTube. Cookies setup required or invalid)."
 
+def timeout_result(url):
+    """期限内に解析が終わらなかった動画の結果"""
+    return {"error": "Deadline exceeded before analysis finished", "status": "timeout", "url": url}
 
-    # 2. Gemini解析 (単体)
-    try:
-        prompt = f"""
+def build_video_prompt(transcript_text):
+    """単体動画解析用のプロンプト"""
+    return f"""
         以下のYouTube動画の字幕テキストを解析し、情報を抽出してください。
         
         出力JSON形式:
@@ -603,32 +1005,558 @@ def process_single_video(url, api_key, provided_transcript=None):
         字幕:
         {transcript_text[:10000]}
         """
-        result = call_gemini_api(prompt, api_key)
-        result['url'] = url
-        result['transcript'] = transcript_text # 個別ダウンロード用
-        return result
+
+def build_video_result(result, url, transcript_text):
+    """Geminiの出力に URL と字幕の参照を付ける"""
+    result['url'] = url
+    result.update(transcript_ref(save_transcript(transcript_text))) # 個別ダウンロード用
+    return result
+
+def build_video_error(e, url, transcript_text):
+    error_trace = traceback.format_exc()
+    print(f"Error in process_single_video for {url}: {e}\n{error_trace}")
+    return {
+        "error": f"AI analysis error: {str(e)}", 
+        "error_detail": error_trace,
+        "url": url,
+        **transcript_ref(save_transcript(transcript_text))
+    }
+
+def process_single_video(url, api_key, provided_transcript=None, deadline=None):
+    """
+    単一の動画を解析する (Map処理)
+    provided_transcript: クライアント側ですでに取得した字幕があればこれを使う
+    deadline: 期限切れ・取り消し時は status=timeout の結果を返す
+    """
+    try:
+        return _process_single_video(url, api_key, provided_transcript, deadline or Deadline())
+    except DeadlineExceeded:
+        print(f"Deadline exceeded for {url}")
+        return timeout_result(url)
+
+def _process_single_video(url, api_key, provided_transcript, deadline):
+    print(f"Processing URL: {url}")
+    video_id = extract_video_id(url)
+    if not video_id:
+        return {"error": "Invalid URL", "url": url}
+
+    transcript_text = ""
+    
+    # 0. クライアント提供の字幕があれば優先使用 (サーバーサイドブロック回避の切り札)
+    if provided_transcript:
+        print("Using provided transcript from client (skipping server-side fetch)")
+        transcript_text = provided_transcript
+    
+    # 以下、サーバーサイド取得ロジック (クライアント取得がなかった場合のみ)
+    if not transcript_text:
+        deadline.check()
+        transcript_text = fetch_transcript_from_youtube(url, video_id, deadline)
+
+    # 方法C: Invidious API (第3の矢: IPブロック回避)
+    if not transcript_text:
+        deadline.check()
+        print("yt-dlp failed. Trying Invidious API fallback...")
+        transcript_text = fetch_transcript_from_invidious(video_id, deadline)
+
+    if not transcript_text:
+        # 詳細なログをサーバーに残すためprint
+        print(f"All methods failed for {url}")
+        return {"error": SUBTITLE_NOT_FOUND_ERROR, "url": url}
+
+    # 2. Gemini解析 (単体)
+    try:
+        result = call_gemini_api(build_video_prompt(transcript_text), api_key, deadline=deadline)
+        return build_video_result(result, url, transcript_text)
+    except DeadlineExceeded:
+        raise
     except Exception as e:
-        error_trace = traceback.format_exc()
-        print(f"Error in process_single_video for {url}: {e}\n{error_trace}")
-        return {
-            "error": f"AI analysis error: {str(e)}", 
-            "error_detail": error_trace,
-            "url": url, 
-            "transcript": transcript_text
-        }
+        return build_video_error(e, url, transcript_text)
+
+
+def _is_valid_store_id(store_id):
+    """ストアIDは sha256 の16進文字列のみ許可 (パストラバーサル防止)"""
+    return len(store_id) == 64 and all(c in '0123456789abcdef' for c in store_id)
+
+def _write_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def save_transcript(transcript_text):
+    """
+    字幕をコンテンツアドレス (sha256) でディスクに保存し、IDを返す。
+    同じ内容なら同じIDになるので、既に保存済みなら書き込まない。
+    gzip版も同時に作っておき、配信時の圧縮コストを省く
+    """
+    import gzip
+    import hashlib
+
+    data = transcript_text.encode('utf-8')
+    transcript_id = hashlib.sha256(data).hexdigest()
+    path = os.path.join(TRANSCRIPT_DIR, f"{transcript_id}.txt")
+    if not os.path.exists(path):
+        os.makedirs(TRANSCRIPT_DIR, exist_ok=True)
+        _write_atomic(path + '.gz', gzip.compress(data))
+        _write_atomic(path, data)
+    return transcript_id
+
+def get_transcript_path(transcript_id):
+    """保存済み字幕のパスを返す。存在しなければNone"""
+    if not _is_valid_store_id(transcript_id):
+        return None
+    path = os.path.join(TRANSCRIPT_DIR, f"{transcript_id}.txt")
+    return path if os.path.exists(path) else None
+
+def load_transcript(transcript_id):
+    """保存済み字幕の本文を返す。存在しなければNone"""
+    path = get_transcript_path(transcript_id)
+    if not path:
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+def transcript_ref(transcript_id):
+    """レスポンスに埋め込む字幕の参照情報"""
+    return {
+        "transcript_id": transcript_id,
+        "transcript_url": f"/api/transcripts/{transcript_id}"
+    }
 
+def save_transcript_bundle(entries):
+    """
+    複数動画の統合ダウンロード用マニフェストを保存し、IDを返す。
+    entries: [{"title": "...", "transcript_id": "..."}]
+    """
+    import hashlib
+
+    data = json.dumps(entries, ensure_ascii=False, sort_keys=True).encode('utf-8')
+    bundle_id = hashlib.sha256(data).hexdigest()
+    path = os.path.join(TRANSCRIPT_DIR, f"{bundle_id}.bundle.json")
+    if not os.path.exists(path):
+        os.makedirs(TRANSCRIPT_DIR, exist_ok=True)
+        _write_atomic(path, data)
+    return bundle_id
+
+def load_transcript_bundle(bundle_id):
+    if not _is_valid_store_id(bundle_id):
+        return None
+    path = os.path.join(TRANSCRIPT_DIR, f"{bundle_id}.bundle.json")
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+@app.route('/api/transcripts/<transcript_id>')
+def get_transcript(transcript_id):
+    """
+    保存済み字幕を返す。IDは内容のハッシュなので、そのままETagとして使える。
+    Rangeリクエストは非圧縮版で応答し、それ以外はgzip対応クライアントにgzip版を返す
+    """
+    path = get_transcript_path(transcript_id)
+    if not path:
+        return jsonify({"error": "Transcript not found"}), 404
+
+    accepts_gzip = request.accept_encodings['gzip'] > 0  # q値を考慮する (gzip;q=0 は拒否)
+    if accepts_gzip and 'Range' not in request.headers and os.path.exists(path + '.gz'):
+        response = send_file(path + '.gz', mimetype='text/plain', etag=f"{transcript_id}-gzip", conditional=True)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = send_file(path, mimetype='text/plain', etag=transcript_id, conditional=True)
+
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+@app.route('/api/transcripts/combined/<bundle_id>')
+def download_combined_transcript(bundle_id):
+    """
+    複数動画の字幕を連結してストリーミングで返す (全体をメモリに載せない)
+    """
+    entries = load_transcript_bundle(bundle_id)
+    if entries is None:
+        return jsonify({"error": "Transcript bundle not found"}), 404
+
+    etag = f'"{bundle_id}"'
+    if etag in request.headers.get('If-None-Match', ''):
+        return Response(status=304, headers={'ETag': etag})
+
+    def generate():
+        for entry in entries:
+            yield f"【動画: {entry.get('title', '')}】\n"
+            path = get_transcript_path(entry.get('transcript_id', ''))
+            if path:
+                with open(path, 'r', encoding='utf-8') as f:
+                    while True:
+                        chunk = f.read(64 * 1024)
+                        if not chunk:
+                            break
+                        yield chunk
+            yield f"\n\n{'='*20}\n\n"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/plain',
+        headers={'ETag': etag, 'Cache-Control': 'public, max-age=31536000, immutable'}
+    )
+
+# ---------------------------------------------------------------
+# 解析結果ストア (SQLite)
+# ---------------------------------------------------------------
+
+_db_local = threading.local()
+_db_init_lock = threading.Lock()
+_db_initialized = False
+_fts_tokenizer = None  # 'trigram' / 'unicode61' / None (FTS5なし)
+
+def get_db():
+    """スレッドごとのSQLite接続を返す (初回のみスキーマ作成)"""
+    global _db_initialized
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        import sqlite3
+        os.makedirs(os.path.dirname(ANALYSIS_DB_PATH) or '.', exist_ok=True)
+        conn = sqlite3.connect(ANALYSIS_DB_PATH, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        _db_local.conn = conn
+    if not _db_initialized:
+        with _db_init_lock:
+            if not _db_initialized:
+                _init_db(conn)
+                _db_initialized = True
+    return conn
+
+def _init_db(conn):
+    global _fts_tokenizer
+    conn.executescript('''
+        CREATE TABLE IF NOT EXISTS analyses (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            video_id TEXT,
+            user_id TEXT,
+            url TEXT,
+            title TEXT,
+            summary TEXT,
+            tasks_text TEXT,
+            result_json TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            source_id INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS idx_analyses_user ON analyses (user_id, created_at, id);
+        CREATE INDEX IF NOT EXISTS idx_analyses_created ON analyses (created_at);
+    ''')
+    # source_id: 他ユーザーの結果を再利用した行の元の行ID (元の解析はNULL)。古いDBには列を追加する
+    columns = {row['name'] for row in conn.execute('PRAGMA table_info(analyses)')}
+    if 'source_id' not in columns:
+        conn.execute('ALTER TABLE analyses ADD COLUMN source_id INTEGER')
+    conn.executescript('''
+        CREATE INDEX IF NOT EXISTS idx_analyses_video ON analyses (video_id, created_at);
+        CREATE INDEX IF NOT EXISTS idx_analyses_source ON analyses (source_id, user_id);
+    ''')
+    # 日本語は空白で区切られないため trigram を優先し、古いSQLiteでは unicode61 にフォールバック
+    for tokenizer in ('trigram', 'unicode61'):
+        try:
+            conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS analyses_fts USING fts5("
+                f"title, summary, tasks_text, content='analyses', content_rowid='id', tokenize='{tokenizer}')"
+            )
+            _fts_tokenizer = tokenizer
+            break
+        except Exception as e:
+            print(f"FTS5 ({tokenizer}) not available: {e}")
+    conn.commit()
+
+def get_session_user_id():
+    """ログイン機能はないため、セッションごとに匿名ユーザーIDを発行する"""
+    if 'user_id' not in session:
+        import uuid
+        session['user_id'] = uuid.uuid4().hex
+    return session['user_id']
+
+def save_analysis(result, user_id=None, video_id=None, kind='video', source_id=None):
+    """
+    解析結果を保存してIDを返す
+    source_id: 他ユーザーの結果を再利用した場合の元の行ID (鮮度の判定には元の行だけを使う)
+    """
+    tasks_text = "\n".join(t.get('text', '') for t in result.get('tasks', []) if isinstance(t, dict))
+    conn = get_db()
+    cur = conn.execute(
+        'INSERT INTO analyses (kind, video_id, user_id, url, title, summary, tasks_text, result_json, created_at, source_id) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        (kind, video_id, user_id, result.get('url'), result.get('title'), result.get('summary'),
+         tasks_text, json.dumps(result, ensure_ascii=False), time.time(), source_id)
+    )
+    analysis_id = cur.lastrowid
+    if _fts_tokenizer:
+        conn.execute(
+            'INSERT INTO analyses_fts (rowid, title, summary, tasks_text) VALUES (?, ?, ?, ?)',
+            (analysis_id, result.get('title'), result.get('summary'), tasks_text)
+        )
+    conn.commit()
+    return analysis_id
+
+def find_fresh_analysis(video_id, max_age=ANALYSIS_FRESH_TTL):
+    """
+    同じ動画の新しい解析結果があれば返す (なければNone)。
+    動画の内容はユーザーに依存しないので、他ユーザーの結果も再利用する。
+    再利用で作ったコピーは対象外 (コピーのたびに期限が延びないよう、実際に解析した時刻で判定する)
+    """
+    row = get_db().execute(
+        "SELECT id, user_id, result_json FROM analyses "
+        "WHERE video_id = ? AND kind = 'video' AND source_id IS NULL AND created_at >= ? "
+        "ORDER BY created_at DESC LIMIT 1",
+        (video_id, time.time() - max_age)
+    ).fetchone()
+    if not row:
+        return None
+    return {"id": row['id'], "user_id": row['user_id'], "result": json.loads(row['result_json'])}
+
+def find_analysis_copy(source_id, user_id):
+    """再利用した結果をこのユーザーの履歴に保存済みならそのIDを返す"""
+    row = get_db().execute(
+        "SELECT id FROM analyses WHERE source_id = ? AND user_id = ? LIMIT 1",
+        (source_id, user_id)
+    ).fetchone()
+    return row['id'] if row else None
+
+def _history_item(row):
+    return {
+        "id": row['id'],
+        "kind": row['kind'],
+        "video_id": row['video_id'],
+        "url": row['url'],
+        "title": row['title'],
+        "summary": row['summary'],
+        "created_at": row['created_at']
+    }
+
+def list_analyses(user_id, limit=20, before=None, query=None, video_id=None):
+    """
+    履歴を新しい順に返す。before は前ページ末尾の "created_at:id" カーソル
+    戻り値: (items, next_cursor)
+    """
+    where = ['a.user_id = ?']
+    params = [user_id]
+    join = ''
+    if video_id:
+        where.append('a.video_id = ?')
+        params.append(video_id)
+    if before:
+        created_at, last_id = before.split(':', 1)
+        where.append('(a.created_at, a.id) < (?, ?)')
+        params += [float(created_at), int(last_id)]
+    if query:
+        # trigramは3文字未満を検索できないため、短いクエリはLIKEで検索する
+        if _fts_tokenizer and (_fts_tokenizer != 'trigram' or len(query) >= 3):
+            join = 'JOIN analyses_fts f ON f.rowid = a.id'
+            where.append('analyses_fts MATCH ?')
+            params.append('"' + query.replace('"', '""') + '"')
+        else:
+            where.append('(a.title LIKE ? OR a.summary LIKE ? OR a.tasks_text LIKE ?)')
+            params += [f"%{query}%"] * 3
+
+    rows = get_db().execute(
+        f"SELECT a.id, a.kind, a.video_id, a.url, a.title, a.summary, a.created_at FROM analyses a {join} "
+        f"WHERE {' AND '.join(where)} ORDER BY a.created_at DESC, a.id DESC LIMIT ?",
+        params + [limit + 1]
+    ).fetchall()
+
+    items = [_history_item(r) for r in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = f"{last['created_at']!r}:{last['id']}"
+    return items, next_cursor
+
+def get_analysis(analysis_id, user_id):
+    row = get_db().execute(
+        'SELECT * FROM analyses WHERE id = ? AND user_id = ?', (analysis_id, user_id)
+    ).fetchone()
+    if not row:
+        return None
+    item = _history_item(row)
+    item['result'] = json.loads(row['result_json'])
+    return item
+
+@app.route('/api/history')
+def get_history():
+    """
+    解析履歴の一覧 (ページング)
+    クエリ: limit, before (カーソル), q (全文検索), video_id
+    """
+    try:
+        limit = min(max(int(request.args.get('limit', 20)), 1), HISTORY_PAGE_SIZE_MAX)
+    except ValueError:
+        return jsonify({"error": "limitは整数で指定してください"}), 400
+
+    try:
+        items, next_cursor = list_analyses(
+            get_session_user_id(),
+            limit=limit,
+            before=request.args.get('before') or None,
+            query=(request.args.get('q') or '').strip() or None,
+            video_id=request.args.get('video_id') or None
+        )
+    except ValueError:
+        return jsonify({"error": "beforeカーソルが不正です"}), 400
+
+    return jsonify({"items": items, "next_cursor": next_cursor})
+
+@app.route('/api/history/<int:analysis_id>')
+def get_history_item(analysis_id):
+    """保存済みの解析結果を1件返す"""
+    item = get_analysis(analysis_id, get_session_user_id())
+    if not item:
+        return jsonify({"error": "History not found"}), 404
+    return jsonify(item)
 
 @app.route('/')
 def index():
     return send_file('index.html')
 
-@app.route('/api/analyze', methods=['POST'])
-def analyze_videos():
-    if not GEMINI_API_KEY:
-        return jsonify({"error": "Gemini APIキーが設定されていません。"}), 500
+def analyze_video_with_store(url, video_id, user_id, provided_transcript=None, force=False, deadline=None, priority='interactive'):
+    """
+    保存済みの新しい結果があればそれを返し、なければ解析して保存する
+    解析はスケジューラーの実行枠を得てから行う (ユーザー間の公平性のため)
+    """
+    if not force:
+        stored = lookup_stored_analysis(url, video_id, user_id)
+        if stored:
+            return stored
 
-    data = request.json
-    
+    from scheduler import SchedulerTimeout
+
+    deadline = deadline or Deadline()
+    try:
+        with get_analysis_scheduler().slot(user_id, priority, timeout=deadline.remaining(), abort=lambda: deadline.cancelled):
+            res = process_single_video(url, GEMINI_API_KEY, provided_transcript=provided_transcript, deadline=deadline)
+    except SchedulerTimeout:
+        print(f"Deadline exceeded while waiting in queue: {url}")
+        return timeout_result(url)
+    return record_analysis(res, user_id, video_id)
+
+def lookup_stored_analysis(url, video_id, user_id):
+    """再利用できる保存済みの結果があれば返す (なければNone)"""
+    if not video_id:
+        return None
+    stored = find_fresh_analysis(video_id)
+    if not stored:
+        return None
+
+    print(f"Using stored analysis for {video_id} (history #{stored['id']})")
+    res = stored['result']
+    res['url'] = url
+    # 他ユーザーの結果を再利用した場合は自分の履歴にも残す (1回だけ)
+    if stored['user_id'] == user_id:
+        res['history_id'] = stored['id']
+    else:
+        res['history_id'] = (
+            find_analysis_copy(stored['id'], user_id)
+            or save_analysis(res, user_id=user_id, video_id=video_id, source_id=stored['id'])
+        )
+    res['cached'] = True
+    return res
+
+def record_analysis(res, user_id, video_id):
+    """成功した解析結果を履歴に保存する"""
+    if "error" not in res:
+        res['history_id'] = save_analysis(res, user_id=user_id, video_id=video_id)
+    return res
+
+def is_collection_url(url):
+    """再生リスト・チャンネルのURLかどうか"""
+    try:
+        parsed_url = urlparse(url)
+    except ValueError:
+        return False
+    if parsed_url.hostname not in ('www.youtube.com', 'youtube.com', 'm.youtube.com'):
+        return False
+    path = parsed_url.path
+    if path == '/playlist':
+        return 'list' in parse_qs(parsed_url.query)
+    return path.startswith(('/@', '/channel/', '/c/', '/user/'))
+
+def _normalize_date(value):
+    """'2024-01-31' / '20240131' を yt-dlp と同じ 'YYYYMMDD' 形式にする"""
+    if not value:
+        return None
+    value = str(value).replace('-', '').replace('/', '')
+    if len(value) != 8 or not value.isdigit():
+        raise ValueError(f"Invalid date: {value}")
+    return value
+
+def expand_collection_url(url, max_items=PLAYLIST_MAX_ITEMS, published_after=None, published_before=None):
+    """
+    再生リスト・チャンネルURLを動画URLのリストに展開する。
+    extract_flat でメタデータのみ取得するので、各動画のページは開かない。
+    published_after / published_before ('YYYYMMDD') で投稿日を絞り込む。
+    投稿日の分からないエントリは除外し、1件も分からなければ ValueError (絞り込めないまま全件を返さない)
+    """
+    import yt_dlp
+
+    parsed_url = urlparse(url)
+    # チャンネルのトップはタブ一覧が返るため、動画タブを明示する
+    if not parsed_url.path.startswith('/playlist'):
+        segments = [p for p in parsed_url.path.split('/') if p]
+        is_handle = segments[0].startswith('@')
+        if (is_handle and len(segments) == 1) or (not is_handle and len(segments) == 2):
+            url = url.split('?')[0].rstrip('/') + '/videos'
+
+    has_date_filter = bool(published_after or published_before)
+    ydl_opts = {
+        'extract_flat': 'in_playlist',
+        'skip_download': True,
+        'quiet': True,
+        # 日付で絞り込む場合は上限より多めに走査する
+        'playlistend': max(max_items, min(max_items * 4, PLAYLIST_SCAN_MAX)) if has_date_filter else max_items,
+    }
+    if has_date_filter:
+        # フラット展開のエントリには通常投稿日が付かないため、「3日前」などの表示からおおよその日付を付けさせる
+        ydl_opts['extractor_args'] = {'youtubetab': {'approximate_date': ['']}}
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=False)
+
+    expanded = []
+    scanned = 0
+    undated = 0
+    for entry in info.get('entries') or []:
+        if not entry or not entry.get('id'):
+            continue
+        scanned += 1
+        upload_date = entry.get('upload_date')
+        if not upload_date and entry.get('timestamp'):
+            upload_date = time.strftime('%Y%m%d', time.gmtime(entry['timestamp']))
+        if has_date_filter:
+            if not upload_date:
+                undated += 1
+                continue
+            if published_after and upload_date < published_after:
+                continue
+            if published_before and upload_date > published_before:
+                continue
+        expanded.append({
+            "url": f"https://www.youtube.com/watch?v={entry['id']}",
+            "title": entry.get('title'),
+            "transcript": None
+        })
+        if len(expanded) >= max_items:
+            break
+
+    if has_date_filter and scanned and undated == scanned:
+        raise ValueError(f"投稿日が取得できないため日付で絞り込めません: {url}")
+    if undated:
+        print(f"Skipped {undated} entries without upload date in {url}")
+    print(f"Expanded {url} -> {len(expanded)} videos")
+    return expanded
+
+def parse_analyze_request(data):
+    """
+    /api/analyze のリクエストから解析対象のitemsとオプションを作る
+    再生リスト・チャンネルURLはここで動画URLに展開する
+    """
     # 新仕様: items [{"url": "...", "transcript": "..."}]
     items = data.get('items', [])
     
@@ -640,42 +1568,147 @@ def analyze_videos():
     # itemsがない場合はurlsから構築
     if not items and urls:
         items = [{"url": u.strip(), "transcript": None} for u in urls if u.strip()]
-    
-    if not items:
-        return jsonify({"error": "URLまたはアイテムが必要です"}), 400
 
-    print(f"Start analyzing {len(items)} videos...")
-    
-    results = []
-    valid_results = []
-    
-    # 1. Mapフェーズ: 個別解析
+    # URLがない場合はスキップ（transcriptだけでの解析は今回は想定外だが、将来的にありかも）
+    items = [item for item in items if item.get('url')]
+
+    max_videos = min(int(data.get('max_videos') or PLAYLIST_MAX_ITEMS), PLAYLIST_MAX_ITEMS)
+    published_after = _normalize_date(data.get('published_after'))
+    published_before = _normalize_date(data.get('published_before'))
+
+    # max_videos は再生リスト・チャンネルから展開した動画の合計の上限 (直接指定した動画URLは数えない)
+    expanded_items = []
+    seen_video_ids = set()
+    collection_videos = 0
     for item in items:
-        url = item.get('url')
-        provided_transcript = item.get('transcript')
-        
-        # URLがない場合はスキップ（transcriptだけでの解析は今回は想定外だが、将来的にありかも）
-        if not url: continue
-        
-        res = process_single_video(url, GEMINI_API_KEY, provided_transcript=provided_transcript)
-        results.append(res)
-        if "error" not in res:
-            valid_results.append(res)
+        if is_collection_url(item['url']):
+            remaining = max_videos - collection_videos
+            if remaining <= 0:
+                print(f"Reached max_videos ({max_videos}). Skipping {item['url']}")
+                continue
+            children = expand_collection_url(
+                item['url'],
+                max_items=remaining,
+                published_after=published_after,
+                published_before=published_before
+            )
+            from_collection = True
+        else:
+            children = [item]
+            from_collection = False
+        for child in children:
+            video_id = extract_video_id(child['url'])
+            # 同じ動画が複数回指定されても1回だけ解析する
+            if video_id:
+                if video_id in seen_video_ids:
+                    continue
+                seen_video_ids.add(video_id)
+            expanded_items.append(child)
+            if from_collection:
+                collection_videos += 1
+
+    options = {
+        "force": bool(data.get('force')),  # trueなら保存済みの結果を使わず再解析
+        "priority": request_priority(len(expanded_items)),
+        "concurrency": min(max(int(data.get('concurrency') or INGEST_CONCURRENCY), 1), INGEST_CONCURRENCY)
+    }
+    return expanded_items, options
+
+def iter_ingestion(items, user_id, force=False, concurrency=INGEST_CONCURRENCY, deadline=None, is_disconnected=None, priority='interactive'):
+    """
+    itemsを並列数を制限して解析し、完了した順に (index, result) をyieldする
+    期限切れになったら未完了の動画を status=timeout としてyieldして終了する。
+    クライアント切断 (is_disconnected() が True、またはジェネレーターが閉じられた場合) は
+    残りの解析を取り消す
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    deadline = deadline or Deadline()
+    executor = ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(items))), thread_name_prefix='ingest')
+    pending = set()
+    try:
+        futures = {}
+        for index, item in enumerate(items):
+            url = item['url']
+            future = executor.submit(
+                analyze_video_with_store, url, extract_video_id(url), user_id,
+                provided_transcript=item.get('transcript'), force=force, deadline=deadline, priority=priority
+            )
+            futures[future] = index
+
+        pending = set(futures)
+        while pending:
+            poll_interval = DISCONNECT_POLL_INTERVAL
+            remaining = deadline.remaining()
+            if remaining is not None:
+                poll_interval = min(poll_interval, remaining)
+            done, pending = wait(pending, timeout=poll_interval, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                index = futures[future]
+                try:
+                    res = future.result()
+                except Exception as e:
+                    traceback.print_exc()
+                    res = {"error": f"Analysis error: {e}", "url": items[index]['url']}
+                yield index, res
+
+            if pending and is_disconnected and is_disconnected():
+                print(f"Client disconnected. Cancelling {len(pending)} videos...")
+                return
+
+            if pending and deadline.expired():
+                print(f"Deadline exceeded. {len(pending)} videos did not finish.")
+                for future in list(pending):
+                    yield futures[future], timeout_result(items[futures[future]]['url'])
+                return
+    finally:
+        if pending:
+            # 実行中の解析にも次の段階で打ち切るよう知らせる
+            deadline.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def prepare_consolidation(results):
+    """
+    統合の準備をする。戻り値: (早期レスポンス, コンテキスト)
+    統合が不要・不可能な場合は早期レスポンス (本体, ステータスコード) を返す
+    """
+    valid_results = [res for res in results if "error" not in res]
+
+    timed_out = any(res.get('status') == 'timeout' for res in results)
 
     # 単一動画の場合はそのまま返す
-    if len(items) == 1:
+    if len(results) == 1:
+        if timed_out:
+            return ({"error": results[0]["error"], "status": "timeout"}, 504), None
         if "error" in results[0]:
-            return jsonify({"error": results[0]["error"]}), 500
-        return jsonify(results[0])
+            return ({"error": results[0]["error"]}, 500), None
+        return (results[0], 200), None
 
     # 2. Reduceフェーズ: 統合解析 (複数動画の場合のみ)
     if not valid_results:
-         return jsonify({
+         if timed_out:
+             return ({
+                 "error": "期限内に解析が完了した動画がありませんでした。",
+                 "status": "timeout",
+                 "details": results
+             }, 504), None
+         return ({
              "error": "全ての動画の解析に失敗しました。",
              "details": results
-         }), 500
+         }, 500), None
 
     print("Consolidating results...")
+
+    # 統合トランスクリプト（ダウンロード用）はマニフェストだけ保存し、参照を返す
+    bundle_id = save_transcript_bundle([
+        {"title": res.get('title', ''), "transcript_id": res.get('transcript_id')}
+        for res in valid_results
+    ])
+    transcript_bundle = {
+        "transcript_bundle_id": bundle_id,
+        "transcript_url": f"/api/transcripts/combined/{bundle_id}"
+    }
     
     # 統合用の入力を生成
     consolidation_input = ""
@@ -687,89 +1720,224 @@ def analyze_videos():
         
         """
 
+    prompt = f"""
+    あなたは「複数の動画から情報を集約し、マスタータスクリストを作る」エキスパートです。
+    以下の複数の動画の解析結果（要約とタスク）を読み込み、全てを統合した「マスター要約」と「マスタータスクリスト」を作成してください。
+    
+    ルール:
+    1. タスクリストは、重複している内容があれば統合してください。
+    2. 全体としてどのような学びやアクションが必要かを要約してください。
+    3. 出力は以下のJSON形式のみです。
+    
+    {{
+        "title": "統合レポート: {valid_results[0].get('title', '')} 他{len(valid_results)-1}本",
+        "summary": "全動画の統合要約(300文字以内)",
+        "tasks": [
+            {{ "id": 1, "text": "統合されたタスク1", "completed": false }}
+        ]
+    }}
+    
+    入力データ:
+    {consolidation_input}
+    """
+    return None, {"prompt": prompt, "transcript_bundle": transcript_bundle}
+
+def finish_consolidation(final_result, results, context, user_id):
+    """Geminiの統合結果に個別結果・字幕参照を付けて保存する"""
+    # 個別結果もクライアントに返すために含める
+    final_result['individual_results'] = results
+    
+    final_result.update(context['transcript_bundle'])
+    final_result['history_id'] = save_analysis(final_result, user_id=user_id, kind='combined')
+    return final_result, 200
+
+def consolidation_failed(e, results, context):
+    """統合に失敗しても個別結果は返す"""
+    error_detail = traceback.format_exc()
+    print(f"Consolidation error: {e}\n{error_detail}")
+    return {
+        "title": "解析完了（統合失敗）",
+        "summary": "動画の個別解析は完了しましたが、統合処理に失敗しました。各動画の結果は下に表示されています。",
+        "tasks": [],
+        "individual_results": results,
+        **context['transcript_bundle'],
+        "error": str(e),
+        "error_detail": error_detail
+    }, 200
+
+def partial_results_response(results, context=None):
+    """
+    期限切れで統合まで終わらなかった場合のレスポンス
+    完了した動画のタスクをそのまま並べ、status=timeout を付ける
+    """
+    valid_results = [res for res in results if "error" not in res]
+    tasks = []
+    for res in valid_results:
+        for task in res.get('tasks', []):
+            tasks.append({**task, "id": len(tasks) + 1})
+
+    payload = {
+        "title": "解析タイムアウト（部分結果）",
+        "summary": f"期限内に{len(valid_results)}/{len(results)}本の解析が完了しました。統合処理は行っていません。",
+        "tasks": tasks,
+        "individual_results": results,
+        "status": "timeout"
+    }
+    if context:
+        payload.update(context['transcript_bundle'])
+    return payload, 200
+
+def consolidate_results(results, user_id, deadline=None, priority='interactive'):
+    """
+    個別結果を統合して (レスポンス本体, ステータスコード) を返す (Reduceフェーズ)
+    """
+    from scheduler import SchedulerTimeout
+
+    deadline = deadline or Deadline()
+    early_response, context = prepare_consolidation(results)
+    if early_response:
+        return early_response
+
+    if deadline.expired():
+        return partial_results_response(results, context)
+
     try:
-        prompt = f"""
-        あなたは「複数の動画から情報を集約し、マスタータスクリストを作る」エキスパートです。
-        以下の複数の動画の解析結果（要約とタスク）を読み込み、全てを統合した「マスター要約」と「マスタータスクリスト」を作成してください。
-        
-        ルール:
-        1. タスクリストは、重複している内容があれば統合してください。
-        2. 全体としてどのような学びやアクションが必要かを要約してください。
-        3. 出力は以下のJSON形式のみです。
-        
-        {{
-            "title": "統合レポート: {valid_results[0].get('title', '')} 他{len(valid_results)-1}本",
-            "summary": "全動画の統合要約(300文字以内)",
-            "tasks": [
-                {{ "id": 1, "text": "統合されたタスク1", "completed": false }}
-            ]
-        }}
-        
-        入力データ:
-        {consolidation_input}
-        """
-        
-        final_result = call_gemini_api(prompt, GEMINI_API_KEY)
-        
-        # 個別結果もクライアントに返すために含める
-        final_result['individual_results'] = results
-        
-        # 統合トランスクリプト（ダウンロード用）
-        combined_transcript = ""
-        for res in valid_results:
-            combined_transcript += f"【動画: {res.get('title','')}】\n{res.get('transcript','')}\n\n{'='*20}\n\n"
-        final_result['transcript'] = combined_transcript
+        with get_analysis_scheduler().slot(user_id, priority, timeout=deadline.remaining(), abort=lambda: deadline.cancelled):
+            final_result = call_gemini_api(context['prompt'], GEMINI_API_KEY, deadline=deadline)
+        return finish_consolidation(final_result, results, context, user_id)
+    except (DeadlineExceeded, SchedulerTimeout):
+        return partial_results_response(results, context)
+    except Exception as e:
+        return consolidation_failed(e, results, context)
 
-        return jsonify(final_result)
+def _prepare_analyze_request():
+    """(items, options, エラーレスポンス) を返す"""
+    if not GEMINI_API_KEY:
+        return None, None, (jsonify({"error": "Gemini APIキーが設定されていません。"}), 500)
 
+    try:
+        # 再生リストの展開も期限に含める
+        deadline = get_request_deadline(request.headers)
+    except ValueError as e:
+        return None, None, (jsonify({"error": f"{DEADLINE_HEADER} が不正です: {e}"}), 400)
+
+    try:
+        items, options = parse_analyze_request(request.json or {})
+        options['deadline'] = deadline
+    except ValueError as e:
+        return None, None, (jsonify({"error": f"パラメータが不正です: {e}"}), 400)
     except Exception as e:
-        error_detail = traceback.format_exc()
-        print(f"Consolidation error: {e}\n{error_detail}")
-        # 統合に失敗しても個別結果は返す
-        return jsonify({
-            "title": "解析完了（統合失敗）",
-            "summary": "動画の個別解析は完了しましたが、統合処理に失敗しました。各動画の結果は下に表示されています。",
-            "tasks": [],
-            "individual_results": results,
-            "error": str(e),
-            "error_detail": error_detail
+        traceback.print_exc()
+        return None, None, (jsonify({"error": f"再生リスト・チャンネルの展開に失敗しました: {e}"}), 500)
+
+    if not items:
+        return None, None, (jsonify({"error": "URLまたはアイテムが必要です"}), 400)
+    return items, options, None
+
+@app.route('/api/analyze', methods=['POST'])
+def analyze_videos():
+    items, options, error_response = _prepare_analyze_request()
+    if error_response:
+        return error_response
+
+    print(f"Start analyzing {len(items)} videos...")
+    user_id = get_session_user_id()
+
+    # クライアントが切断したら残りの解析を取り消す
+    environ = request.environ
+    is_disconnected = lambda: client_disconnected(environ)
+
+    # 1. Mapフェーズ: 個別解析 (並列)
+    results = [None] * len(items)
+    for index, res in iter_ingestion(items, user_id, is_disconnected=is_disconnected, **options):
+        results[index] = res
+
+    if any(res is None for res in results):
+        # 切断で打ち切った場合は誰も受け取らないので統合もしない
+        print("Client disconnected. Skipping consolidation.")
+        return Response(status=499)
+
+    payload, status = consolidate_results(results, user_id, deadline=options['deadline'], priority=options['priority'])
+    return jsonify(payload), status
+
+@app.route('/api/analyze/stream', methods=['POST'])
+def analyze_videos_stream():
+    """
+    /api/analyze と同じ処理を行い、進捗をNDJSON (1行1イベント) でストリーミングする
+    イベント: expanded → progress (動画ごと、完了順) → done
+    """
+    items, options, error_response = _prepare_analyze_request()
+    if error_response:
+        return error_response
+
+    print(f"Start analyzing {len(items)} videos (stream)...")
+    user_id = get_session_user_id()
+
+    def event(data):
+        return json.dumps(data, ensure_ascii=False) + "\n"
+
+    # 切断は進捗の書き込み失敗 (ジェネレーターのクローズ) を待たず、ソケットを監視して検知する
+    environ = request.environ
+    is_disconnected = lambda: client_disconnected(environ)
+
+    def generate():
+        yield event({
+            "event": "expanded",
+            "total": len(items),
+            "items": [{"url": item['url'], "title": item.get('title')} for item in items]
         })
+        results = [None] * len(items)
+        completed = 0
+        for index, res in iter_ingestion(items, user_id, is_disconnected=is_disconnected, **options):
+            results[index] = res
+            completed += 1
+            yield event({"event": "progress", "index": index, "completed": completed, "total": len(items), "result": res})
+
+        if any(res is None for res in results):
+            # 切断で打ち切った場合は誰も受け取らないので統合もしない
+            print("Client disconnected. Skipping consolidation.")
+            return
+
+        payload, status = consolidate_results(results, user_id, deadline=options['deadline'], priority=options['priority'])
+        yield event({"event": "done", "status": status, "result": payload})
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@app.route('/api/metrics/scheduler')
+def scheduler_metrics():
+    """スケジューラーのキュー長・実行数・優先度別のキュー待ち時間 (p50 / p95)"""
+    return jsonify(get_analysis_scheduler().stats())
 
 @app.route('/api/debug_info')
 def debug_info():
     """デバッグ情報を返す (認証なし・開発用)"""
     import yt_dlp
     
-    cookies_exists = os.path.exists('cookies.txt')
+    cookies_exists = os.path.exists(COOKIES_FILE)
     env_cookies_len = len(os.environ.get('YOUTUBE_COOKIES', ''))
     
     # yt-dlpからバージョン取得
     ytdlp_version = yt_dlp.version.__version__
-    
-    # 実際にクッキーファイルが生成できるかテスト
-    temp_cookie_path = "Not created"
-    if os.environ.get('YOUTUBE_COOKIES'):
-        try:
-            import tempfile
-            with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.txt') as tf:
-                tf.write(os.environ.get('YOUTUBE_COOKIES'))
-                temp_cookie_path = tf.name
-            # すぐ消す
-            os.unlink(temp_cookie_path)
-            temp_cookie_path = "Created successfully"
-        except Exception as e:
-            temp_cookie_path = f"Error: {e}"
+
+    cookie_provider.refresh_if_changed()
 
     return jsonify({
         "cookies_txt_exists": cookies_exists,
-        "cookies_txt_size": os.path.getsize('cookies.txt') if cookies_exists else 0,
+        "cookies_txt_size": os.path.getsize(COOKIES_FILE) if cookies_exists else 0,
         "env_YOUTUBE_COOKIES_len": env_cookies_len,
-        "temp_cookie_creation_test": temp_cookie_path,
+        "cookies": cookie_provider.status(),
         "yt_dlp_version": ytdlp_version,
         "cwd": os.getcwd(),
         "ls_cwd": os.listdir('.')
     })
 
+# YouTube用Cookieは起動時に一度だけ読み込む (以降は cookies.txt の更新時のみ)
+cookie_provider.load()
+
+# 起動後のバックグラウンド事前読み込み (gunicornワーカー起動時にも実行される)
+start_background_warmup()
+
 if __name__ == '__main__':
     print("----------------------------------------------------------------")
     print("Server starting at http://localhost:8000")
@@ -0,0 +1,82 @@
+import os
+import sys
+import subprocess
+
+# server.py の import 時間の回帰チェック (python -X importtime の内訳を集計する)
+# 使い方: python test_import_time.py [上位表示件数]
+
+# 起動時に読み込んではいけない重いモジュール (初回利用時に遅延importする)
+FORBIDDEN_AT_STARTUP = [
+    'requests',
+    'yt_dlp',
+    'youtube_transcript_api',
+    'google_auth_oauthlib',
+    'googleapiclient',
+    'google.auth',
+    'google.oauth2',
+]
+
+# server.py 全体の import 時間の上限 (マイクロ秒)。CI環境に合わせて環境変数で調整可能
+IMPORT_BUDGET_US = int(os.environ.get('IMPORT_BUDGET_US', 400000))
+
+def measure_import_time():
+    """
+    別プロセスで `python -X importtime -c "import server"` を実行し、
+    [(モジュール名, self時間us, 累積時間us), ...] を返す
+    """
+    env = dict(os.environ)
+    env['WARMUP_IMPORTS'] = '0'  # バックグラウンド事前読み込みは計測対象外
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import server'],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"import server failed:\n{proc.stderr}")
+
+    rows = []
+    for line in proc.stderr.splitlines():
+        # 形式: "import time:      self [us] |  cumulative | imported package"
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3:
+            continue
+        try:
+            self_us = int(parts[0].strip())
+            cumulative_us = int(parts[1].strip())
+        except ValueError:
+            continue  # ヘッダー行
+        rows.append((parts[2].strip(), self_us, cumulative_us))
+    return rows
+
+def print_breakdown(rows, top=20):
+    print(f"{'cumulative[us]':>15} {'self[us]':>10}  module")
+    for name, self_us, cumulative_us in sorted(rows, key=lambda r: r[2], reverse=True)[:top]:
+        print(f"{cumulative_us:>15} {self_us:>10}  {name}")
+
+def test_server_import_time():
+    print("Measuring server.py import time...")
+    rows = measure_import_time()
+    server_row = next((r for r in rows if r[0] == 'server'), None)
+    assert server_row is not None, "server module not found in importtime output"
+
+    imported = {name for name, _, _ in rows}
+    leaked = [m for m in FORBIDDEN_AT_STARTUP if m in imported]
+    assert not leaked, f"Heavy modules imported at startup: {leaked}"
+
+    total_us = server_row[2]
+    print(f"server import: {total_us / 1000:.1f} ms (budget {IMPORT_BUDGET_US / 1000:.1f} ms)")
+    assert total_us <= IMPORT_BUDGET_US, f"server import took {total_us}us (> {IMPORT_BUDGET_US}us)"
+
+if __name__ == "__main__":
+    top = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    print_breakdown(measure_import_time(), top=top)
+    try:
+        test_server_import_time()
+        print("PASSED: import time within budget")
+    except AssertionError as e:
+        print(f"FAILED: {e}")
+        sys.exit(1)
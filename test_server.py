@@ -56,6 +56,71 @@ def test_google_tasks_endpoints():
     except Exception as e:
         print(f"Google Tasks Test Failed: {e}")
 
+def test_deadline_header():
+    print("\nTesting request deadline header...")
+    try:
+        payload = {"urls": ["https://www.youtube.com/watch?v=S30R3i26Xh4"]}
+        # 不正な期限は400
+        response = requests.post(f"{BASE_URL}/api/analyze", json=payload, headers={"X-Request-Timeout": "-1"})
+        print(f"Invalid deadline: {response.status_code}") # Should be 400
+
+        # 極端に短い期限ではタイムアウト状態が返る (保存済みの結果があれば200)
+        response = requests.post(f"{BASE_URL}/api/analyze", json=payload, headers={"X-Request-Timeout": "0.01"}, timeout=60)
+        print(f"Short deadline: {response.status_code}, status={response.json().get('status')}") # 504 + timeout expected
+    except Exception as e:
+        print(f"Deadline Test Failed: {e}")
+
+def test_transcript_endpoints():
+    print("\nTesting transcript endpoints...")
+    try:
+        # 存在しないIDは404
+        response = requests.get(f"{BASE_URL}/api/transcripts/{'0'*64}")
+        print(f"Unknown transcript: {response.status_code}") # Should be 404
+
+        # ID形式でないものも404 (パストラバーサル防止)
+        response = requests.get(f"{BASE_URL}/api/transcripts/..%2Fserver.py")
+        print(f"Invalid transcript id: {response.status_code}") # Should be 404
+
+        response = requests.get(f"{BASE_URL}/api/transcripts/combined/{'0'*64}")
+        print(f"Unknown bundle: {response.status_code}") # Should be 404
+    except Exception as e:
+        print(f"Transcript Test Failed: {e}")
+
+def test_history_endpoints():
+    print("\nTesting history endpoints...")
+    try:
+        session = requests.Session()
+        response = session.get(f"{BASE_URL}/api/history?limit=5")
+        print(f"History List: {response.status_code}") # Should be 200
+        data = response.json()
+        if "items" in data and "next_cursor" in data:
+            print(f"History List PASSED: {len(data['items'])} items")
+        else:
+            print("History List FAILED: 'items' or 'next_cursor' missing")
+
+        response = session.get(f"{BASE_URL}/api/history?limit=abc")
+        print(f"History Invalid limit: {response.status_code}") # Should be 400
+
+        response = session.get(f"{BASE_URL}/api/history/999999999")
+        print(f"History Unknown id: {response.status_code}") # Should be 404
+    except Exception as e:
+        print(f"History Test Failed: {e}")
+
+def test_scheduler_metrics():
+    print("\nTesting scheduler metrics endpoint...")
+    try:
+        response = requests.get(f"{BASE_URL}/api/metrics/scheduler")
+        print(f"Status: {response.status_code}")
+        stats = response.json()
+        print(f"Running: {stats.get('running')}/{stats.get('slots')}, queued: {stats.get('queued')}")
+        print(f"Queue wait: {stats.get('queue_wait_seconds')}")
+    except Exception as e:
+        print(f"Scheduler Metrics Test Failed: {e}")
+
 if __name__ == "__main__":
     test_analyze_endpoint()
     test_google_tasks_endpoints()
+    test_deadline_header()
+    test_transcript_endpoints()
+    test_history_endpoints()
+    test_scheduler_metrics()
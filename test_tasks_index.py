@@ -0,0 +1,77 @@
+import os
+import sys
+import tempfile
+
+# Google Tasks エクスポートの重複判定 (既存タスク索引) のチェック
+# サーバーを起動せずに server.py の関数を直接呼ぶ。使い方: python test_tasks_index.py
+
+os.environ.setdefault('WARMUP_IMPORTS', '0')
+os.environ['TASKS_INDEX_DIR'] = tempfile.mkdtemp(prefix='tasks_index_')
+
+import server
+
+def build_index(tasklist_id, items):
+    index = server.new_tasks_index(tasklist_id)
+    server.merge_task_changes(index, items)
+    return index, server.build_title_index(index)
+
+def test_plan_task_export():
+    print("Testing plan_task_export...")
+    index, title_index = build_index('list-a', [
+        {"id": "t1", "title": "資料を作成する", "notes": "動画A", "status": "needsAction"},
+        {"id": "t2", "title": "Done Task", "notes": "", "status": "completed"},
+    ])
+
+    # 新しいタイトルは追加
+    assert server.plan_task_export(index, title_index, {"title": "新しいタスク"}) == ('insert', None)
+    # 全角半角・大文字小文字・空白の違いは同じタスクとみなす
+    assert server.plan_task_export(index, title_index, {"title": " 資料を作成する ", "notes": "動画A"}) == ('skip', 't1')
+    assert server.plan_task_export(index, title_index, {"title": "ＤＯＮＥ  task"}) == ('skip', 't2')
+    # メモだけ違う未完了タスクは更新 (on_duplicate='skip' ならスキップ)
+    assert server.plan_task_export(index, title_index, {"title": "資料を作成する", "notes": "動画B"}) == ('update', 't1')
+    assert server.plan_task_export(index, title_index, {"title": "資料を作成する", "notes": "動画B"}, on_duplicate='skip') == ('skip', 't1')
+    # 完了済みのタスクは更新しない
+    assert server.plan_task_export(index, title_index, {"title": "Done Task", "notes": "x"}) == ('skip', 't2')
+
+def test_merge_task_changes():
+    print("Testing merge_task_changes...")
+    index, _ = build_index('list-a', [
+        {"id": "t1", "title": "A", "status": "needsAction"},
+        {"id": "t2", "title": "B", "status": "needsAction"},
+    ])
+    # 差分 (updatedMin) の反映: 削除・変更・追加
+    server.merge_task_changes(index, [
+        {"id": "t1", "deleted": True},
+        {"id": "t2", "title": "B2", "status": "completed"},
+        {"id": "t3", "title": "C", "status": "needsAction"},
+    ])
+    assert set(index['tasks']) == {'t2', 't3'}
+    assert index['tasks']['t2'] == {"title": "B2", "notes": "", "status": "completed"}
+    assert server.plan_task_export(index, server.build_title_index(index), {"title": "A"}) == ('insert', None)
+
+def test_index_keyed_by_resolved_id():
+    print("Testing tasks index keys...")
+    index, _ = build_index('list-a', [{"id": "t1", "title": "A", "status": "needsAction"}])
+    server.save_tasks_index('list-a', index)
+    assert server.load_tasks_index('list-a')['tasks'] == index['tasks']
+    # 別名はアカウント間で共通なのでキャッシュしない
+    assert server.load_tasks_index('@default') is None
+    try:
+        server.save_tasks_index('@default', index)
+        assert False, "alias key must be rejected"
+    except ValueError:
+        pass
+    # 別のリストの索引が同じキーに置かれていても使わない
+    server._write_atomic(server._tasks_index_path('list-b'), server.json.dumps(index).encode('utf-8'))
+    assert server.load_tasks_index('list-b') is None
+
+if __name__ == "__main__":
+    failed = False
+    for test in (test_plan_task_export, test_merge_task_changes, test_index_keyed_by_resolved_id):
+        try:
+            test()
+            print(f"PASSED: {test.__name__}")
+        except AssertionError as e:
+            failed = True
+            print(f"FAILED: {test.__name__} {e}")
+    sys.exit(1 if failed else 0)